@@ -1,70 +1,103 @@
 #!/bin/env python3
 
-import csv
-import json
 import logging
-import resource
+from itertools import count
+from collections import defaultdict
+from typing import NamedTuple, Tuple
 
 from locust import task, constant
 from locust import events
 from locust.runners import MasterRunner, WorkerRunner
 
-import gevent
-from matrix_locust.users.matrixuser import MatrixUser
+from gevent.event import Event
+from gevent.pool import Pool
+from matrix_locust.users import matrixuser
+from matrix_locust.users.matrixuser import MatrixUser, load_users_csv, INPUT_FILE_BUFFERING, raise_file_limit, \
+    register_users_handler, split_users_between_workers
+from matrix_locust.nio.contrib import json_loads
 from nio.responses import RoomCreateError, LoginError
 
+logger = logging.getLogger(__name__)
+
 # Preflight ####################################################################
 
+class RoomInfo(NamedTuple):
+    """A room to be created, along with the user IDs to invite to it"""
+    name: str
+    user_ids: Tuple[str, ...]
+
 def username_to_userid(username, domain=None):
-    user_id = username
-    if not user_id.startswith("@"):
-        user_id = "@" + username
-    if domain is not None and not ":" in user_id:
-        user_id += ":" + domain
-    return user_id
+    user_id = username if username[:1] == "@" else f"@{username}"
+    if domain is None or ":" in user_id:
+        return user_id
+    return f"{user_id}:{domain}"
+
+# Never set; greenlets with no users left to process wait on it indefinitely
+park_event = Event()
 
 @events.init.add_listener
 def on_locust_init(environment, **_kwargs):
     # Increase resource limits to prevent OS running out of descriptors
-    try:
-        resource.setrlimit(resource.RLIMIT_NOFILE, (999999, 999999))
-    except ValueError as e:
-        logging.warning(f"Failed to increase the resource limit: {e}")
+    raise_file_limit()
 
     # Multi-worker
     if isinstance(environment.runner, WorkerRunner):
         print(f"Registered 'load_users' handler on {environment.runner.client_id}")
-        environment.runner.register_message("load_users", MatrixRoomCreatorUser.load_users)
+        register_users_handler(environment.runner, MatrixRoomCreatorUser.load_users)
+        print(f"Registered 'load_rooms' handler on {environment.runner.client_id}")
+        environment.runner.register_message("load_rooms", MatrixRoomCreatorUser.load_rooms)
     # Single-worker
     elif not isinstance(environment.runner, WorkerRunner) and not isinstance(environment.runner, MasterRunner):
         # Open our list of users
-        MatrixRoomCreatorUser.worker_users = csv.DictReader(open("users.csv"))
+        MatrixRoomCreatorUser.worker_users = load_users_csv()
 
 @events.test_start.add_listener
 def on_test_start(environment, **_kwargs):
-    if not isinstance(environment.runner, MasterRunner):
-        user_reader = csv.DictReader(open("users.csv", "r", encoding="utf-8"))
-
-        # Load our list of rooms to be created
-        logging.info("Loading rooms list")
-        rooms = {}
-        with open("rooms.json", "r", encoding="utf-8") as rooms_jsonfile:
-            rooms = json.load(rooms_jsonfile)
-        logging.info("Success loading rooms list")
-
-        # Now we need to sort of invert the list
-        # We need a list of the rooms to be created by each user,
-        # with the list of other users who should be invited to each
-        MatrixRoomCreatorUser.worker_rooms_for_users = {}
+    # Workers get their share of the rooms from the master instead of each parsing rooms.json
+    if isinstance(environment.runner, WorkerRunner):
+        return
+
+    # Load our list of rooms to be created
+    logger.info("Loading rooms list")
+    rooms = {}
+    with open("rooms.json", "rb", buffering=INPUT_FILE_BUFFERING) as rooms_jsonfile:
+        rooms = json_loads(rooms_jsonfile.read())
+    logger.info("Success loading rooms list")
+
+    # Multi-worker
+    if isinstance(environment.runner, MasterRunner):
+        # Send each worker only the rooms to be created by the users it was given
+        worker_for_user = {}
+        worker_rooms = {}
+        for (client_id, users) in split_users_between_workers(environment.runner, matrixuser.locust_users).items():
+            worker_rooms[client_id] = {}
+            for user in users:
+                worker_for_user[user["username"]] = client_id
+
         for room_name, room_users in rooms.items():
-            first_user = username_to_userid(room_users[0])
-            user_rooms = MatrixRoomCreatorUser.worker_rooms_for_users.get(first_user, [])
-            room_info = {
-                "name": room_name,
-                "users": room_users[1:]
-            }
-            user_rooms.append(room_info)
-            MatrixRoomCreatorUser.worker_rooms_for_users[first_user] = user_rooms
+            client_id = worker_for_user.get(room_users[0])
+            if client_id is not None:
+                worker_rooms[client_id][room_name] = room_users
+
+        for (client_id, client_rooms) in worker_rooms.items():
+            print(f"Sending {len(client_rooms)} rooms to {client_id}")
+            environment.runner.send_message("load_rooms", client_rooms, client_id)
+    # Single-worker
+    else:
+        MatrixRoomCreatorUser.worker_rooms_for_users = index_rooms_by_creator(rooms)
+
+def index_rooms_by_creator(rooms):
+    """Inverts the rooms list into the rooms to be created by each user
+
+    Each user's entry lists the rooms they create, along with the other
+    users who should be invited to each
+    """
+    rooms_for_users = defaultdict(list)
+    for room_name, room_users in rooms.items():
+        first_user = username_to_userid(room_users[0])
+        rooms_for_users[first_user].append(
+            RoomInfo(room_name, tuple(username_to_userid(username) for username in room_users[1:])))
+    return dict(rooms_for_users)
 
 ###############################################################################
 
@@ -74,72 +107,83 @@ class MatrixRoomCreatorUser(MatrixUser):
 
     worker_id = None
     worker_users = []
+    worker_users_index = count()
     worker_rooms_for_users = {}
 
+    # Number of rooms each user creates concurrently
+    room_creation_concurrency = 8
+    # Keep-alive connections in each user's pool, enough for all of the concurrent room creations
+    concurrency = room_creation_concurrency
+
     @staticmethod
     def load_users(environment, msg, **_kwargs):
-        MatrixRoomCreatorUser.worker_users = iter(msg.data)
+        MatrixRoomCreatorUser.worker_users = msg.data
+        MatrixRoomCreatorUser.worker_users_index = count()
         MatrixRoomCreatorUser.worker_id = environment.runner.client_id
-        logging.info("Worker [%s]: Received %s users", environment.runner.client_id, len(msg.data))
+        logger.info("Worker [%s]: Received %s users", environment.runner.client_id, len(msg.data))
+
+    @staticmethod
+    def load_rooms(environment, msg, **_kwargs):
+        MatrixRoomCreatorUser.worker_rooms_for_users = index_rooms_by_creator(msg.data)
+        logger.info("Worker [%s]: Received %s rooms", environment.runner.client_id, len(msg.data))
 
     @task
     def create_rooms_for_user(self):
-        # Multiple locust users re-use the same class instance, so need to reset the state
-        self.reset_client()
-
         # Load the next user for room creation
         try:
-            user = next(MatrixRoomCreatorUser.worker_users)
-        except StopIteration:
+            user = MatrixRoomCreatorUser.worker_users[next(MatrixRoomCreatorUser.worker_users_index)]
+        except IndexError:
             # We can't shut down the worker until all users are registered, so return
             # early to stop this individual co-routine
-            gevent.sleep(999999)
+            park_event.wait()
             return
 
+        # Multiple locust users re-use the same class instance, so need to reset the state,
+        # unless it's still the untouched client built in __init__
+        if self.matrix_client.user:
+            self.reset_client()
+
         self.login_from_csv(user)
 
         if self.matrix_client.user is None or self.matrix_client.password is None:
-            logging.error("[%s]: Couldn't get username/password. Skipping...",
-                          MatrixRoomCreatorUser.worker_id)
+            logger.error("[%s]: Couldn't get username/password. Skipping...",
+                         MatrixRoomCreatorUser.worker_id)
             return
 
         # Log in as this current user if not already logged in
-        if self.matrix_client.user_id is None or self.matrix_client.access_token is None or \
-            len(self.matrix_client.user_id) < 1 or len(self.matrix_client.access_token) < 1:
-
+        if not (self.matrix_client.user_id and self.matrix_client.access_token):
             response = self.matrix_client.login(self.matrix_client.password)
 
             if isinstance(response, LoginError):
-                logging.error("Login failed for User [%s]", self.matrix_client.user)
+                logger.error("Login failed for User [%s]", self.matrix_client.user)
                 return
 
         my_rooms_info = MatrixRoomCreatorUser.worker_rooms_for_users.get(
             username_to_userid(self.matrix_client.user, self.matrix_client.matrix_domain), [])
         #logging.info("User [%s] Found %d rooms to be created", self.username, len(my_rooms_info))
 
-        for room_info in my_rooms_info:
-            room_name = room_info["name"]
-            #room_alias = room_name.lower().replace(" ", "-")
-            usernames = room_info["users"]
-            user_ids = list(map(username_to_userid, usernames))
-            logging.info("User [%s] Creating room [%s] with %d users",
-                         self.matrix_client.user, room_name, len(user_ids))
-
-            # Actually create the room
-            retries = 3
-            while retries > 0:
-                response = self.matrix_client.room_create(alias=None, name=room_name, invite=user_ids, federate=True)
-
-                if isinstance(response, RoomCreateError):
-                    logging.error("[%s] Could not create room %s (attempt %d). Trying again...",
-                                 self.matrix_client.user, room_name, 4 - retries)
-                    logging.error("[%s] Code=%s, Message=%s", self.matrix_client.user,
-                                  response.status_code, response.message)
-                    retries -= 1
-                else:
-                    logging.info("[%s] Created room [%s]", self.matrix_client.user, response.room_id)
-                    break
-
-            if retries == 0:
-                logging.error("[%s] Error creating room %s. Skipping...",
-                              self.matrix_client.user, room_name)
+        # Overlap the round-trips of this user's room creations
+        Pool(MatrixRoomCreatorUser.room_creation_concurrency).map(self._create_room, my_rooms_info)
+
+    def _create_room(self, room_info):
+        room_name = room_info.name
+        #room_alias = room_name.lower().replace(" ", "-")
+        user_ids = room_info.user_ids
+        logger.debug("User [%s] Creating room [%s] with %d users",
+                     self.matrix_client.user, room_name, len(user_ids))
+
+        # Actually create the room
+        for attempt in range(1, 4):
+            response = self.matrix_client.room_create(alias=None, name=room_name, invite=user_ids, federate=True)
+
+            if isinstance(response, RoomCreateError):
+                logger.error("[%s] Could not create room %s (attempt %d). Trying again...",
+                             self.matrix_client.user, room_name, attempt)
+                logger.error("[%s] Code=%s, Message=%s", self.matrix_client.user,
+                             response.status_code, response.message)
+            else:
+                logger.debug("[%s] Created room [%s]", self.matrix_client.user, response.room_id)
+                break
+        else:
+            logger.error("[%s] Error creating room %s. Skipping...",
+                         self.matrix_client.user, room_name)
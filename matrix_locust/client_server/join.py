@@ -1,35 +1,37 @@
 #!/bin/env python3
 
-import csv
-import resource
 import logging
+from itertools import count
 
 from locust import task, constant
 from locust import events
 from locust.runners import MasterRunner, WorkerRunner
 
-import gevent
-from matrix_locust.users.matrixuser import MatrixUser
+from gevent.event import Event
+from gevent.pool import Pool
+from matrix_locust.users.matrixuser import MatrixUser, load_users_csv, raise_file_limit, register_users_handler
 from nio.responses import JoinError, LoginError, SyncError
 
+logger = logging.getLogger(__name__)
+
 # Preflight ###############################################
 
+# Never set; greenlets with no users left to process wait on it indefinitely
+park_event = Event()
+
 @events.init.add_listener
 def on_locust_init(environment, **_kwargs):
     # Increase resource limits to prevent OS running out of descriptors
-    try:
-        resource.setrlimit(resource.RLIMIT_NOFILE, (999999, 999999))
-    except ValueError as e:
-        logging.warning(f"Failed to increase the resource limit: {e}")
+    raise_file_limit()
 
     # Multi-worker
     if isinstance(environment.runner, WorkerRunner):
         print(f"Registered 'load_users' handler on {environment.runner.client_id}")
-        environment.runner.register_message("load_users", MatrixInviteAcceptorUser.load_users)
+        register_users_handler(environment.runner, MatrixInviteAcceptorUser.load_users)
     # Single-worker
     elif not isinstance(environment.runner, WorkerRunner) and not isinstance(environment.runner, MasterRunner):
         # Open our list of users
-        MatrixInviteAcceptorUser.worker_users = csv.DictReader(open("users.csv"))
+        MatrixInviteAcceptorUser.worker_users = load_users_csv()
 
 ###########################################################
 
@@ -39,67 +41,74 @@ class MatrixInviteAcceptorUser(MatrixUser):
 
     worker_id = None
     worker_users = []
+    worker_users_index = count()
+
+    # Number of invites each user accepts concurrently
+    join_concurrency = 16
+    # Keep-alive connections in each user's pool, enough for all of the concurrent joins
+    concurrency = join_concurrency
 
     @staticmethod
     def load_users(environment, msg, **_kwargs):
-        MatrixInviteAcceptorUser.worker_users = iter(msg.data)
+        MatrixInviteAcceptorUser.worker_users = msg.data
+        MatrixInviteAcceptorUser.worker_users_index = count()
         MatrixInviteAcceptorUser.worker_id = environment.runner.client_id
-        logging.info("Worker [%s]: Received %s users", environment.runner.client_id, len(msg.data))
+        logger.info("Worker [%s]: Received %s users", environment.runner.client_id, len(msg.data))
 
     @task
     def accept_invites(self):
-        # Multiple locust users re-use the same class instance, so need to reset the state
-        self.reset_client()
-
         # Load the next user
         try:
-            user = next(MatrixInviteAcceptorUser.worker_users)
-        except StopIteration:
+            user = MatrixInviteAcceptorUser.worker_users[next(MatrixInviteAcceptorUser.worker_users_index)]
+        except IndexError:
             # We can't shut down the worker until all users are registered, so return
             # early to stop this individual co-routine
-            gevent.sleep(999999)
+            park_event.wait()
             return
 
+        # Multiple locust users re-use the same class instance, so need to reset the state,
+        # unless it's still the untouched client built in __init__
+        if self.matrix_client.user:
+            self.reset_client()
+
         self.login_from_csv(user)
 
         if self.matrix_client.user is None or self.matrix_client.password is None:
-            logging.error("Couldn't get username/password. Skipping...")
+            logger.error("Couldn't get username/password. Skipping...")
             return
 
         # Log in as this current user if not already logged in
-        if self.matrix_client.user_id is None or self.matrix_client.access_token is None or \
-            len(self.matrix_client.user_id) < 1 or len(self.matrix_client.access_token) < 1:
-
+        if not (self.matrix_client.user_id and self.matrix_client.access_token):
             response = self.matrix_client.login(self.matrix_client.password)
 
             if isinstance(response, LoginError):
-                logging.error("Login failed for User [%s]", self.matrix_client.user)
+                logger.error("Login failed for User [%s]", self.matrix_client.user)
                 return
 
         # Call /sync to get our list of invited rooms
         response = self.matrix_client.sync()
 
         if isinstance(response, SyncError):
-            logging.error("[%s] /sync error (%s): %s", self.matrix_client.user,
-                          response.status_code, response.message)
-
-        invited_rooms = self.matrix_client.invited_rooms.keys()
-
-        logging.info("User [%s] has %d pending invites", self.matrix_client.user, len(invited_rooms))
-        for room_id in invited_rooms:
-            retries = 3
-            while retries > 0:
-                response = self.matrix_client.join(room_id)
-
-                if isinstance(response, JoinError):
-                    logging.error("[%s] Could not join room %s (attempt %d). Trying again...",
-                                 self.matrix_client.user, room_id, 4 - retries)
-                    logging.error("[%s] Code=%s, Message=%s", self.matrix_client.user,
-                                  response.status_code, response.message)
-                    retries -= 1
-                else:
-                    logging.info("[%s] Joined room %s", self.matrix_client.user, room_id)
-                    break
-
-            if retries == 0:
-                logging.error("[%s] Error joining room %s. Skipping...", self.matrix_client.user, room_id)
+            logger.error("[%s] /sync error (%s): %s", self.matrix_client.user,
+                         response.status_code, response.message)
+
+        # Snapshot the invites so the joins don't iterate over a live view
+        invited_rooms = list(self.matrix_client.invited_rooms)
+
+        logger.info("User [%s] has %d pending invites", self.matrix_client.user, len(invited_rooms))
+        Pool(MatrixInviteAcceptorUser.join_concurrency).map(self._join_room, invited_rooms)
+
+    def _join_room(self, room_id):
+        for attempt in range(1, 4):
+            response = self.matrix_client.join(room_id)
+
+            if isinstance(response, JoinError):
+                logger.error("[%s] Could not join room %s (attempt %d). Trying again...",
+                             self.matrix_client.user, room_id, attempt)
+                logger.error("[%s] Code=%s, Message=%s", self.matrix_client.user,
+                             response.status_code, response.message)
+            else:
+                logger.debug("[%s] Joined room %s", self.matrix_client.user, room_id)
+                break
+        else:
+            logger.error("[%s] Error joining room %s. Skipping...", self.matrix_client.user, room_id)
@@ -1,35 +1,36 @@
 #!/bin/env python3
 
-import csv
 import logging
-import resource
+from itertools import count
 
 from locust import task, constant
 from locust import events
 from locust.runners import MasterRunner, WorkerRunner
 
-import gevent
-from matrix_locust.users.matrixuser import MatrixUser
+from gevent.event import Event
+from matrix_locust.users.matrixuser import MatrixUser, load_users_csv, raise_file_limit, register_users_handler
 from nio.responses import RegisterErrorResponse
 
+logger = logging.getLogger(__name__)
+
 # Preflight ####################################################################
 
+# Never set; greenlets with no users left to process wait on it indefinitely
+park_event = Event()
+
 @events.init.add_listener
 def on_locust_init(environment, **_kwargs):
     # Increase resource limits to prevent OS running out of descriptors
-    try:
-        resource.setrlimit(resource.RLIMIT_NOFILE, (999999, 999999))
-    except ValueError as e:
-        logging.warning(f"Failed to increase the resource limit: {e}")
+    raise_file_limit()
 
     # Multi-worker
     if isinstance(environment.runner, WorkerRunner):
         print(f"Registered 'load_users' handler on {environment.runner.client_id}")
-        environment.runner.register_message("load_users", MatrixRegisterUser.load_users)
+        register_users_handler(environment.runner, MatrixRegisterUser.load_users)
     # Single-worker
     elif not isinstance(environment.runner, WorkerRunner) and not isinstance(environment.runner, MasterRunner):
         # Open our list of users
-        MatrixRegisterUser.worker_users = csv.DictReader(open("users.csv"))
+        MatrixRegisterUser.worker_users = load_users_csv()
 
 ################################################################################
 
@@ -38,45 +39,47 @@ class MatrixRegisterUser(MatrixUser):
     wait_time = constant(0)
     worker_id = None
     worker_users = []
+    worker_users_index = count()
 
     @staticmethod
     def load_users(environment, msg, **_kwargs):
-        MatrixRegisterUser.worker_users = iter(msg.data)
+        MatrixRegisterUser.worker_users = msg.data
+        MatrixRegisterUser.worker_users_index = count()
         MatrixRegisterUser.worker_id = environment.runner.client_id
-        logging.info("Worker [%s] Received %s users", environment.runner.client_id, len(msg.data))
+        logger.info("Worker [%s] Received %s users", environment.runner.client_id, len(msg.data))
 
     @task
     def register_user(self):
-        # Multiple locust users re-use the same class instance, so need to reset the state
-        self.reset_client()
-
         # Load the next user who needs to be registered
         try:
-            user = next(MatrixRegisterUser.worker_users)
-        except StopIteration:
+            user = MatrixRegisterUser.worker_users[next(MatrixRegisterUser.worker_users_index)]
+        except IndexError:
             # We can't shut down the worker until all users are registered, so return
             # early to stop this individual co-routine
-            gevent.sleep(999999)
+            park_event.wait()
             return
 
+        # Multiple locust users re-use the same class instance, so need to reset the state,
+        # unless it's still the untouched client built in __init__
+        if self.matrix_client.user:
+            self.reset_client()
+
         self.set_user(user["username"])
         self.matrix_client.password = user["password"]
 
         if self.matrix_client.user is None or self.matrix_client.password is None:
-            logging.error("Couldn't get username/password. Skipping...")
+            logger.error("Couldn't get username/password. Skipping...")
             return
 
-        retries = 3
-        while retries > 0:
+        for attempt in range(1, 4):
             # Register with the server to get a user_id and access_token
             response = self.matrix_client.register(self.matrix_client.user, self.matrix_client.password, token="")
 
             if isinstance(response, RegisterErrorResponse):
-                logging.info("[%s] Could not register user (attempt %d). Trying again...",
-                             self.matrix_client.user, 4 - retries)
-                retries -= 1
+                logger.info("[%s] Could not register user (attempt %d). Trying again...",
+                            self.matrix_client.user, attempt)
                 continue
 
             return
 
-        logging.error("Error registering user %s. Skipping...", self.matrix_client.user)
+        logger.error("Error registering user %s. Skipping...", self.matrix_client.user)
@@ -16,15 +16,298 @@
 
 # temp containing extensions for future PRs
 
-from typing import Any, Dict, Optional, Tuple
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
 from dataclasses import dataclass
+from functools import lru_cache
+from urllib.parse import quote
 
-from nio.api import Api
+from nio.api import Api, MessageDirection, RoomPreset, RoomVisibility
 from nio import ErrorResponse, Response, Schemas
 from nio.responses import verify
 
+# The JSON functions used throughout matrix_locust. orjson is optional, fall back
+# to the stdlib json module (through nio's compact encoder) if it's not installed.
+# orjson's bytes are sent as they are, without a round-trip through str
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+    json_dumps = Api.to_json
+
+# Body for the requests that don't take any parameters
+EMPTY_JSON_BODY = b"{}"
+
+# The endpoints below are built straight against v3, rather than nio's r0 paths
+CLIENT_API_PATH = "/_matrix/client/v3"
+
+# The wire values of the room creation enums, looked up in a dict instead of
+# going through the Enum.value property on every call. Plain strings pass through
+_ROOM_VISIBILITY_VALUES = {visibility: visibility.value for visibility in RoomVisibility}
+_ROOM_PRESET_VALUES = {preset: preset.value for preset in RoomPreset}
+
+@lru_cache(maxsize=4096)
+def _quote(part: str) -> str:
+    """Percent-encodes (and memoizes) a path segment or query value.
+
+    Only used for values that repeat across requests, like access tokens,
+    room ids and event types.
+    """
+    return quote(part, safe="")
+
+def _query(access_token: str, **query_parameters) -> str:
+    """Builds the query string for a request, skipping any unset parameters."""
+    query = f"?access_token={_quote(access_token)}"
+    for key, value in query_parameters.items():
+        if value is None:
+            continue
+        # quote() takes the serialized filters as they are, str or bytes
+        if not isinstance(value, (str, bytes)):
+            value = str(value)
+        query += f"&{key}={quote(value, safe='')}"
+    return query
+
+def _state_path(room_id: str, event_type: str, state_key: str) -> str:
+    # Like Api._build_path, an empty state_key leaves no trailing slash
+    path = f"{CLIENT_API_PATH}/rooms/{_quote(room_id)}/state/{_quote(event_type)}"
+    if state_key:
+        path += f"/{_quote(state_key)}"
+    return path
+
+@lru_cache(maxsize=4096)
+def _room_send_prefix(room_id: str, event_type: str) -> str:
+    """Builds (and memoizes) the path for room sends, up to the transaction id."""
+    return f"{CLIENT_API_PATH}/rooms/{_quote(room_id)}/send/{_quote(event_type)}/"
+
+@lru_cache(maxsize=16)
+def _typing_body(typing_state: bool, timeout: int) -> Union[str, bytes]:
+    """Encodes (and memoizes) the typing notice body, which only varies with its arguments."""
+    content = {"typing": typing_state}
+    if typing_state:
+        content["timeout"] = timeout
+    return json_dumps(content)
+
+@lru_cache(maxsize=4096)
+def _tags_path(access_token: str, user_id: str, room_id: str, tag: Optional[str] = None) -> str:
+    """Builds (and memoizes) the path for the room tags endpoints."""
+    path = f"{CLIENT_API_PATH}/user/{_quote(user_id)}/rooms/{_quote(room_id)}/tags"
+    if tag is not None:
+        path += f"/{_quote(tag)}"
+
+    return path + _query(access_token)
+
 
 class ApiExt(Api):
+    """Api with extra endpoints, plus faster builders for the endpoints
+    that a load test hits over and over.
+
+    The builders below return the same (method, path[, data]) tuples as
+    their Api counterparts, but skip the generic path builder, memoize the
+    encoding of values that repeat and build v3 paths directly.
+    """
+
+    @staticmethod
+    def room_send(
+        access_token: str,
+        room_id: str,
+        event_type: str,
+        body: Dict[Any, Any],
+        tx_id: str,
+    ) -> Tuple[str, str, Union[str, bytes]]:
+        """Send a message event to a room, see Api.room_send."""
+        return ("PUT", f"{_room_send_prefix(room_id, event_type)}{quote(str(tx_id), safe='')}{_query(access_token)}",
+                json_dumps(body))
+
+    @staticmethod
+    def room_put_state(
+        access_token: str,
+        room_id: str,
+        event_type: str,
+        body: Union[Dict[Any, Any], str, bytes],
+        state_key: str = "",
+    ) -> Tuple[str, str, Union[str, bytes]]:
+        """Send a state event, see Api.room_put_state.
+
+        The body may also be given already encoded, for content that never changes.
+        """
+        if not isinstance(body, (str, bytes)):
+            body = json_dumps(body)
+        return ("PUT", _state_path(room_id, event_type, state_key) + _query(access_token), body)
+
+    @staticmethod
+    def room_create(
+        access_token: str,
+        visibility: Union[RoomVisibility, str] = RoomVisibility.private,
+        alias: Optional[str] = None,
+        name: Optional[str] = None,
+        topic: Optional[str] = None,
+        room_version: Optional[str] = None,
+        federate: bool = True,
+        is_direct: bool = False,
+        preset: Union[RoomPreset, str, None] = None,
+        invite: Sequence[str] = (),
+        initial_state: Sequence[Dict[str, Any]] = (),
+        power_level_override: Optional[Dict[str, Any]] = None,
+        predecessor: Optional[Dict[str, Any]] = None,
+        space: bool = False,
+    ) -> Tuple[str, str, Union[str, bytes]]:
+        """Create a new room, see Api.room_create."""
+        body = {
+            "visibility": _ROOM_VISIBILITY_VALUES.get(visibility, visibility),
+            "creation_content": {"m.federate": federate},
+            "is_direct": is_direct,
+        }
+
+        if alias:
+            body["room_alias_name"] = alias
+
+        if name:
+            body["name"] = name
+
+        if topic:
+            body["topic"] = topic
+
+        if room_version:
+            body["room_version"] = room_version
+
+        if preset:
+            body["preset"] = _ROOM_PRESET_VALUES.get(preset, preset)
+
+        if invite:
+            body["invite"] = list(invite)
+
+        if initial_state:
+            body["initial_state"] = list(initial_state)
+
+        if power_level_override:
+            body["power_level_content_override"] = power_level_override
+
+        if predecessor:
+            body["creation_content"]["predecessor"] = predecessor
+
+        if space:
+            body["creation_content"]["type"] = "m.space"
+
+        return ("POST", f"{CLIENT_API_PATH}/createRoom{_query(access_token)}", json_dumps(body))
+
+    @staticmethod
+    def join(access_token: str, room_id: str) -> Tuple[str, str, bytes]:
+        """Join a room, see Api.join."""
+        return ("POST", f"{CLIENT_API_PATH}/join/{_quote(room_id)}{_query(access_token)}", EMPTY_JSON_BODY)
+
+    @staticmethod
+    def profile_set_displayname(
+        access_token: str,
+        user_id: str,
+        display_name: str,
+    ) -> Tuple[str, str, Union[str, bytes]]:
+        """Set a user's display name, see Api.profile_set_displayname."""
+        return ("PUT", f"{CLIENT_API_PATH}/profile/{_quote(user_id)}/displayname{_query(access_token)}",
+                json_dumps({"displayname": display_name}))
+
+    @staticmethod
+    def profile_set_avatar(
+        access_token: str,
+        user_id: str,
+        avatar_url: str,
+    ) -> Tuple[str, str, Union[str, bytes]]:
+        """Set a user's avatar URL, see Api.profile_set_avatar."""
+        return ("PUT", f"{CLIENT_API_PATH}/profile/{_quote(user_id)}/avatar_url{_query(access_token)}",
+                json_dumps({"avatar_url": avatar_url}))
+
+    @staticmethod
+    def room_get_state_event(
+        access_token: str,
+        room_id: str,
+        event_type: str,
+        state_key: str = "",
+    ) -> Tuple[str, str]:
+        """Fetch a state event, see Api.room_get_state_event."""
+        return ("GET", _state_path(room_id, event_type, state_key) + _query(access_token))
+
+    @staticmethod
+    def room_get_state(access_token: str, room_id: str) -> Tuple[str, str]:
+        """Fetch the current state for a room, see Api.room_get_state."""
+        return ("GET", f"{CLIENT_API_PATH}/rooms/{_quote(room_id)}/state{_query(access_token)}")
+
+    @staticmethod
+    def room_typing(
+        access_token: str,
+        room_id: str,
+        user_id: str,
+        typing_state: bool = True,
+        timeout: int = 30000,
+    ) -> Tuple[str, str, Union[str, bytes]]:
+        """Send a typing notice to the server, see Api.room_typing."""
+        return ("PUT", f"{CLIENT_API_PATH}/rooms/{_quote(room_id)}/typing/{_quote(user_id)}{_query(access_token)}",
+                _typing_body(typing_state, timeout))
+
+    @staticmethod
+    def update_receipt_marker(
+        access_token: str,
+        room_id: str,
+        event_id: str,
+        receipt_type: str = "m.read",
+    ) -> Tuple[str, str, bytes]:
+        """Update a receipt marker, see Api.update_receipt_marker.
+
+        Unlike Api.update_receipt_marker, this also returns the (empty) body,
+        since the server rejects the request without one.
+        """
+        return ("POST", f"{CLIENT_API_PATH}/rooms/{_quote(room_id)}/receipt/{_quote(receipt_type)}/"
+                        f"{quote(event_id, safe='')}{_query(access_token)}", EMPTY_JSON_BODY)
+
+    @staticmethod
+    def room_messages(
+        access_token: str,
+        room_id: str,
+        start: str,
+        end: Optional[str] = None,
+        direction: Union[MessageDirection, str] = MessageDirection.back,
+        limit: int = 10,
+        message_filter: Optional[Dict[Any, Any]] = None,
+    ) -> Tuple[str, str]:
+        """Get room messages, see Api.room_messages."""
+        if isinstance(direction, str):
+            if direction in ("b", "back"):
+                direction = MessageDirection.back
+            elif direction in ("f", "front"):
+                direction = MessageDirection.front
+            else:
+                raise ValueError("Invalid direction")
+
+        query = _query(
+            access_token,
+            **{"from": start},
+            limit=limit,
+            to=end or None,
+            dir="f" if direction is MessageDirection.front else "b",
+            filter=json_dumps(message_filter) if isinstance(message_filter, dict) else None,
+        )
+        return "GET", f"{CLIENT_API_PATH}/rooms/{_quote(room_id)}/messages{query}"
+
+    @staticmethod
+    def sync(
+        access_token: str,
+        since: Optional[str] = None,
+        timeout: Optional[int] = None,
+        filter: Union[None, str, Dict[Any, Any]] = None,
+        full_state: Optional[bool] = None,
+        set_presence: Optional[str] = None,
+    ) -> Tuple[str, str]:
+        """Synchronise the client's state with the server, see Api.sync."""
+        if isinstance(filter, dict):
+            filter = json_dumps(filter)
+
+        query = _query(
+            access_token,
+            since=since or None,
+            full_state=None if full_state is None else str(full_state).lower(),
+            timeout=timeout,
+            set_presence=set_presence or None,
+            filter=filter,
+        )
+        return "GET", f"{CLIENT_API_PATH}/sync{query}"
+
     @staticmethod
     def get_tags(
         access_token: str,
@@ -43,9 +326,6 @@ class ApiExt(Api):
             receipt_type (str): The type of receipt to send. Currently, only
                 `m.read` is supported by the Matrix specification.
         """
-        query_parameters = {"access_token": access_token}
-        path = ["user", user_id, "rooms", room_id, "tags"]
-
         #  GET /_matrix/client/v3/user/{userId}/rooms/{roomId}/tags
         # body = {
         #     "visibility": visibility.value,
@@ -60,7 +340,7 @@ class ApiExt(Api):
         #     body["name"] = name
 
 
-        return ("GET", Api._build_path(path, query_parameters))
+        return ("GET", _tags_path(access_token, user_id, room_id))
         # return ("POST", Api._build_path(path, query_parameters), Api.to_json(body))
 
     @staticmethod
@@ -83,14 +363,11 @@ class ApiExt(Api):
             receipt_type (str): The type of receipt to send. Currently, only
                 `m.read` is supported by the Matrix specification.
         """
-        query_parameters = {"access_token": access_token}
-        path = ["user", user_id, "rooms", room_id, "tags", tag]
-
         #  PUT /_matrix/client/v3/user/{userId}/rooms/{roomId}/tags/{tag}
-        body = {}
+        if order is None:
+            return ("PUT", _tags_path(access_token, user_id, room_id, tag), EMPTY_JSON_BODY)
 
-        if not(order is None):
-            body["order"] = order
+        body = {"order": order}
 
         # add validation for the following?
 
@@ -104,7 +381,7 @@ class ApiExt(Api):
 
 
         # return ("PUT", Api._build_path(path, query_parameters))
-        return ("PUT", Api._build_path(path, query_parameters), Api.to_json(body))
+        return ("PUT", _tags_path(access_token, user_id, room_id, tag), json_dumps(body))
 
 
 # todo: add remove tags (DELETE)
@@ -14,13 +14,9 @@
 # # CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF OR IN
 # # CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 
-import cgi
-import json
-import pprint
 from builtins import str, super
 from collections import deque
-from dataclasses import dataclass, field
-from functools import wraps
+from functools import lru_cache, wraps
 from typing import (
     Any,
     AsyncIterable,
@@ -30,6 +26,7 @@ from typing import (
     Dict,
     Iterable,
     List,
+    NamedTuple,
     Optional,
     Sequence,
     Set,
@@ -37,7 +34,7 @@ from typing import (
     Type,
     Union,
 )
-from uuid import UUID, uuid4
+from uuid import UUID
 
 import nio.api
 from nio.api import (
@@ -56,6 +53,7 @@ from nio.responses import (
     DeleteDevicesAuthResponse,
     DeleteDevicesResponse,
     DevicesResponse,
+    DownloadError,
     DownloadResponse,
     ErrorResponse,
     FileResponse,
@@ -75,6 +73,7 @@ from nio.responses import (
     ProfileGetAvatarResponse,
     ProfileGetDisplayNameError,
     ProfileGetDisplayNameResponse,
+    ProfileGetError,
     ProfileGetResponse,
     ProfileSetAvatarError,
     ProfileSetAvatarResponse,
@@ -110,40 +109,194 @@ from nio.responses import (
     UpdateReceiptMarkerResponse,
 )
 from nio.client import Client, ClientConfig
-from nio.client.base_client import logged_in, store_loaded
+from nio.client.base_client import store_loaded
+from nio.exceptions import LocalProtocolError
 
 import logging
 from locust import User
 from http import HTTPStatus
 from collections import namedtuple
 
-import binascii
 import base64
 import sys
 import os
+from time import perf_counter
+from urllib.parse import urlparse
+
+import gevent
+
+logger = logging.getLogger(__name__)
 
 # BSSpeke UIA stages are optional
 try:
     sys.path.append(os.path.join(os.path.dirname(__file__), "..", "bsspeke", "python"))
     from ..bsspeke.python import BSSpeke
 except ImportError:
-    logging.warning("Optional BSSpeke module not found. BSSpeke UIA stages will failif used.")
+    logger.warning("Optional BSSpeke module not found. BSSpeke UIA stages will failif used.")
 
 from matrix_locust.nio.contrib import (
     ApiExt,
+    json_dumps,
+    json_loads,
     RoomGetTagsError,
     RoomGetTagsResponse,
     RoomSetTagsError,
     RoomSetTagsResponse,
 )
 
-@dataclass
-class ResponseCb:
-    """Response callback."""
-
-    func: Callable = field()
+# nio's (r0) endpoint prefixes and the versioned prefixes we send requests to instead.
+# Each Api builder only returns paths under one of them, so each request is only
+# checked against its own
+CLIENT_API_PATH_REWRITE = (nio.api.MATRIX_API_PATH, "/_matrix/client/v3")
+MEDIA_API_PATH_REWRITE = (nio.api.MATRIX_MEDIA_API_PATH, "/_matrix/media/v3")
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Accept': 'application/json'}
+
+# The Api builders, bound once at module level instead of looked up on the class per call
+_api_join = ApiExt.join
+_api_login = Api.login
+_api_logout = Api.logout
+_api_profile_get = Api.profile_get
+_api_profile_get_avatar = Api.profile_get_avatar
+_api_profile_get_displayname = Api.profile_get_displayname
+_api_profile_set_avatar = ApiExt.profile_set_avatar
+_api_profile_set_displayname = ApiExt.profile_set_displayname
+_api_register = Api.register
+_api_room_create = ApiExt.room_create
+_api_room_get_state = ApiExt.room_get_state
+_api_room_get_state_event = ApiExt.room_get_state_event
+_api_room_messages = ApiExt.room_messages
+_api_room_put_state = ApiExt.room_put_state
+_api_room_send = ApiExt.room_send
+_api_room_typing = ApiExt.room_typing
+_api_sync = ApiExt.sync
+_api_update_receipt_marker = ApiExt.update_receipt_marker
+_api_get_tags = ApiExt.get_tags
+_api_download = Api.download
+_api_set_tags = ApiExt.set_tags
+
+# The Locust stats names for the endpoints, without any of the ids in their paths
+LABEL_LOGIN = "/_matrix/client/v3/login"
+LABEL_LOGOUT = "/_matrix/client/v3/logout"
+LABEL_SYNC = "/_matrix/client/v3/sync"
+LABEL_CREATE_ROOM = "/_matrix/client/v3/createRoom"
+LABEL_JOIN = "/_matrix/client/v3/join/_"
+LABEL_ROOM_STATE = "/_matrix/client/v3/rooms/_/state/"
+LABEL_ROOM_MESSAGES = "/_matrix/client/v3/rooms/_/messages"
+LABEL_ROOM_TYPING = "/_matrix/client/v3/rooms/_/typing/_"
+LABEL_RECEIPT = "/_matrix/client/v3/rooms/_/receipt/m.read/_"
+LABEL_ROOM_TAGS = "/_matrix/client/v3/user/_/rooms/_/tags"
+LABEL_PROFILE = "/_matrix/client/v3/profile/_"
+LABEL_DISPLAYNAME = "/_matrix/client/v3/profile/_/displayname"
+LABEL_AVATAR_URL = "/_matrix/client/v3/profile/_/avatar_url"
+LABEL_DOWNLOAD = "/_matrix/media/v3/download/_/_"
+
+@lru_cache(maxsize=None)
+def state_label(event_type: str) -> str:
+    """Returns the Locust stats name for a room state event endpoint
+
+    There are only a handful of state event types, so each label is built once
+    """
+    return f"/_matrix/client/v3/rooms/_/state/{event_type}/_"
+
+@lru_cache(maxsize=None)
+def send_label(event_type: str) -> str:
+    """Returns the Locust stats name for sending a room event, built once per event type"""
+    return f"/_matrix/client/v3/rooms/_/send/{event_type}/_"
+
+# Transaction IDs are sliced out of a shared buffer of random bytes, refilled a
+# batch at a time, instead of making an os.urandom() call and a UUID per message
+TXN_ID_BYTES = 16
+TXN_ID_BUFFER_SIZE = 4096
+_txn_id_buffer = b""
+_txn_id_offset = 0
+
+def new_txn_id() -> str:
+    """Returns a random hex transaction ID for sending an event"""
+    global _txn_id_buffer, _txn_id_offset
+    if _txn_id_offset >= len(_txn_id_buffer):
+        _txn_id_buffer = os.urandom(TXN_ID_BUFFER_SIZE)
+        _txn_id_offset = 0
+    start = _txn_id_offset
+    _txn_id_offset += TXN_ID_BYTES
+    return _txn_id_buffer[start:_txn_id_offset].hex()
+
+# Hand-specialized versions of from_dict() for the simple responses that a load
+# test gets most often. Each one returns None for anything but the exact success
+# shape, so errors (and anything unexpected) still go through nio's from_dict()
+
+def _parse_event_id_response(response: Type[Response], js: Dict[str, Any], response_data: Tuple[Any, ...]):
+    event_id = js.get("event_id")
+    if type(event_id) is str:
+        return response(event_id, *response_data)
+    return None
+
+def _parse_room_id_response(response: Type[Response], js: Dict[str, Any], response_data: Tuple[Any, ...]):
+    room_id = js.get("room_id")
+    if type(room_id) is str:
+        return response(room_id, *response_data)
+    return None
+
+def _parse_empty_response(response: Type[Response], js: Dict[str, Any], response_data: Tuple[Any, ...]):
+    if not js:
+        return response(*response_data)
+    return None
+
+FAST_RESPONSE_PARSERS = {
+    RoomSendResponse: _parse_event_id_response,
+    RoomPutStateResponse: _parse_event_id_response,
+    JoinResponse: _parse_room_id_response,
+    RoomCreateResponse: _parse_room_id_response,
+    RoomTypingResponse: _parse_empty_response,
+    UpdateReceiptMarkerResponse: _parse_empty_response,
+    ProfileSetDisplayNameResponse: _parse_empty_response,
+    ProfileSetAvatarResponse: _parse_empty_response,
+}
+
+# Longest slice of a response body to include in an error message
+ERROR_BODY_LOG_LIMIT = 512
+
+def _fmt_err(resp) -> str:
+    """Returns the start of a response's raw body for logging
+
+    Error responses aren't always JSON (e.g. a proxy's HTML error page), and
+    may be large, so the body is neither parsed nor logged in full
+    """
+    content = resp.content
+    if not content:
+        return ""
+    return content[:ERROR_BODY_LOG_LIMIT].decode("utf-8", "replace")
+
+def logged_in(func):
+    """Like nio's logged_in decorator, but checks the access token directly
+    instead of going through the Client.logged_in property on every call"""
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not self.access_token:
+            raise LocalProtocolError("Not logged in.")
+        return func(self, *args, **kwargs)
+
+    return wrapper
+
+class ResponseCb(NamedTuple):
+    """Response callback, stored as a plain (func, filter) tuple."""
+
+    func: Callable
     filter: Union[Tuple[Type], Type, None] = None
 
+def _register_password_stage(client, auth, token):
+    auth["identifier"] = {"type": "m.id.user", "user": client.user}
+    auth["password"] = client.password
+
+def _register_token_stage(client, auth, token):
+    auth["token"] = token
+
+# Fills in the auth dict for the UIA stages that register() knows how to complete
+REGISTER_STAGE_HANDLERS = {
+    "m.login.password": _register_password_stage,
+    "m.login.registration_token": _register_token_stage,
+}
+
 class LocustClient(Client):
     """Matrix no-IO client.
 
@@ -181,55 +334,130 @@ class LocustClient(Client):
         config: Optional[ClientConfig] = None,
     ):
         self.locust_user = locust_user
+        # Bound once, since _send goes through it for every API call
+        self._request = locust_user.client.request
         self.response_callbacks: List[ResponseCb] = []
+        # Index of the callbacks above, by the response types they are filtered on
+        self._response_callbacks_any: List[Callable] = []
+        self._response_callbacks_by_type: Dict[Type, List[Callable]] = {}
+        # All of the callbacks to run for each concrete response type, resolved on first use
+        self._resolved_response_callbacks: Dict[Type, Tuple[Callable, ...]] = {}
 
         self.password = ""
         self.matrix_domain = None
 
         super().__init__(user, device_id, store_path, config)
 
-    def _build_request(self, api_response):
-        """Utility function for changing endpoint versioning"""
-        return_items = []
-        for item in api_response:
-            if nio.api.MATRIX_API_PATH in item:
-                return_items.append(item.replace(nio.api.MATRIX_API_PATH,
-                                                 "/_matrix/client/v3"))
-            elif nio.api.MATRIX_MEDIA_API_PATH in item:
-                return_items.append(item.replace(nio.api.MATRIX_MEDIA_API_PATH,
-                                                 "/_matrix/media/v3"))
-            else:
-                return_items.append(item)
+    def _set_identity(self, user_id):
+        """Sets the user_id along with the matrix_domain derived from it"""
+        self.user_id = user_id
+        self.matrix_domain = user_id.rpartition(":")[2] if user_id else None
 
-        # Hacky way to allow unpacking a tuple return value
-        return (*return_items,)
+    def _apply_auth_response(self, js) -> bool:
+        """Takes the user_id, access_token and device_id from a successful
+        /register or /login response
+
+        Returns False if the response was missing the user_id or access_token
+        """
+        self._set_identity(js.get("user_id"))
+        self.access_token = js.get("access_token")
+        self.device_id = js.get("device_id", self.device_id)
+        return bool(self.user_id and self.access_token)
+
+    @staticmethod
+    def _rewrite_request(api_response, old_prefix: str, new_prefix: str):
+        """Utility function for changing endpoint versioning
+
+        Only the path is rewritten, the method and body are passed through as-is.
+        Requests built by ApiExt already have v3 paths, so they don't need this.
+        """
+        method, path = api_response[0], api_response[1]
+        # nio's endpoint prefixes always start the path, so there's no need to search all of it
+        if path.startswith(old_prefix):
+            path = new_prefix + path[len(old_prefix):]
+
+        # The Api builders return either (method, path) or (method, path, data)
+        if len(api_response) == 2:
+            return method, path
+        return method, path, api_response[2]
+
+    def _build_client_request(self, api_response):
+        """Rewrites a request built by Api for one of the client endpoints to v3"""
+        return self._rewrite_request(api_response, *CLIENT_API_PATH_REWRITE)
+
+    def _build_media_request(self, api_response):
+        """Rewrites a request built by Api for one of the media endpoints to v3"""
+        return self._rewrite_request(api_response, *MEDIA_API_PATH_REWRITE)
 
     def _send(self,
               response: Response,
               method: str,
               url: str,
-              body: str = None,
-              name: str = None,
-              *response_data,
+              body: Union[str, bytes, None],
+              name: str,
+              response_data: Tuple[Any, ...] = (),
     ):
-        headers = { 'Content-Type': 'application/json', 'Accept': 'application/json' }
-
-        if body is not None:
-            body = json.loads(body)
-
-        # Strip out url parameters from Locust logs
-        if name is None and "?" in url:
-            name = url[:url.find("?")]
-
+        # name is the constant Locust stats label for the endpoint, without the
+        # url parameters (or any ids), so it's never derived from the url here
         # Send request and update internal state of the object with the response
-        # logging.info("[%s] Making API call to %s" % (self.user, url))
-        with self.locust_user.rest(method, url, headers=headers, json=body, name=name) as resp:
-            matrix_response = response.from_dict(resp.js, *response_data)
-            self.receive_response(matrix_response)
-            self.run_response_callbacks([matrix_response])
+        # The Api helpers already return the body serialized, so send it as-is.
+        # The response is parsed straight from the raw bytes rather than through
+        # rest(), which decodes the whole body to a str for the stdlib parser first.
+        # request() adds its own headers to the dict it's given, so pass a copy
+        # With debug logging on, time the round-trip separately from the client-side
+        # processing of the response, which never yields to other greenlets
+        timed = logger.isEnabledFor(logging.DEBUG)
+        if timed:
+            start = perf_counter()
+        with self._request(method, url, data=body, name=name, headers=dict(JSON_HEADERS),
+                           catch_response=True) as resp:
+            if timed:
+                received = perf_counter()
+            # Like rest(), a missing or unparseable body leaves js as None, which nio turns into
+            # the endpoint's error response. An empty dict would pass as a success for the
+            # endpoints that reply with {}
+            js = None
+            if resp.content is None:
+                resp.failure(str(resp.error))
+            elif resp.content:
+                try:
+                    js = json_loads(resp.content)
+                except ValueError as e:
+                    resp.failure(f"Could not parse response as JSON, response code {resp.status_code}, error {e}")
+            # Also like rest(), anything raised while handling the response marks the sample as
+            # failed, rather than escaping without the request ever being reported
+            try:
+                matrix_response = None
+                if type(js) is dict:
+                    fast_parser = FAST_RESPONSE_PARSERS.get(response)
+                    if fast_parser is not None:
+                        matrix_response = fast_parser(response, js, response_data)
+                if matrix_response is None:
+                    matrix_response = response.from_dict(js, *response_data)
+                self.receive_response(matrix_response)
+                if self.response_callbacks:
+                    self.run_response_callbacks((matrix_response,))
+            except Exception as e:
+                resp.failure(f"{e.__class__.__name__}: {e}. Response was {_fmt_err(resp)}")
+                logger.exception("[%s] %s %s: error handling the response", self.user, method, name)
+                return None
+            if timed:
+                logger.debug("[%s] %s %s: %.2f ms waiting on the server, %.2f ms processing the response",
+                              self.user, method, name, (received - start) * 1000,
+                              (perf_counter() - received) * 1000)
             return matrix_response
 
 
+    def _send_api(self, response: Response, name: str, response_data: Tuple[Any, ...], api_request, *args):
+        """Builds a request with one of the ApiExt builders and sends it
+
+        The builder is passed the access token, followed by the given args.
+        Its paths are already versioned, so the request skips _build_client_request.
+        """
+        request = api_request(self.access_token, *args)
+        body = request[2] if len(request) == 3 else None
+        return self._send(response, request[0], request[1], body, name, response_data)
+
     def add_response_callback(
         self,
         func: Coroutine[Any, Any, Response],
@@ -256,20 +484,49 @@ class LocustClient(Client):
         """
         cb = ResponseCb(func, cb_filter)  # type: ignore
         self.response_callbacks.append(cb)
+        self._resolved_response_callbacks.clear()
+
+        if cb_filter is None:
+            self._response_callbacks_any.append(func)
+            return
+
+        filter_types = cb_filter if isinstance(cb_filter, tuple) else (cb_filter,)
+        for filter_type in filter_types:
+            # A subclass of another filter type is already covered by the MRO walk
+            if any(filter_type is not other and issubclass(filter_type, other) for other in filter_types):
+                continue
+            self._response_callbacks_by_type.setdefault(filter_type, []).append(func)
 
     def run_response_callbacks(
-        self, responses: List[Union[Response, ErrorResponse]]
+        self, responses: Sequence[Union[Response, ErrorResponse]]
     ):
         """Run the configured response callbacks for the given responses.
 
         Low-level function which is normally only used by other methods of
         this class. Automatically called by sync_forever() and all functions
         calling receive_response().
+
+        Unfiltered callbacks run first, followed by the callbacks filtered on
+        each type in the response's MRO.
         """
+        if not self.response_callbacks:
+            return
+
+        resolved = self._resolved_response_callbacks
         for response in responses:
-            for cb in self.response_callbacks:
-                if cb.filter is None or isinstance(response, cb.filter):
-                    cb.func(response)
+            response_type = type(response)
+            callbacks = resolved.get(response_type)
+            if callbacks is None:
+                callbacks = resolved[response_type] = self._resolve_response_callbacks(response_type)
+            for func in callbacks:
+                func(response)
+
+    def _resolve_response_callbacks(self, response_type: Type) -> Tuple[Callable, ...]:
+        """Collects the callbacks to run for responses of the given type"""
+        callbacks = list(self._response_callbacks_any)
+        for base_type in response_type.__mro__:
+            callbacks.extend(self._response_callbacks_by_type.get(base_type, ()))
+        return tuple(callbacks)
 
     def login(
         self,
@@ -298,7 +555,7 @@ class LocustClient(Client):
         if password is None and token is None:
             raise ValueError("Either a password or a token needs to be provided")
 
-        method, path, data = self._build_request(Api.login(
+        method, path, data = self._build_client_request(_api_login(
             self.user,
             password=password,
             device_name=device_name,
@@ -307,10 +564,10 @@ class LocustClient(Client):
         ))
 
         self.password = password
-        response = self._send(LoginResponse, method, path, data)
+        response = self._send(LoginResponse, method, path, data, LABEL_LOGIN)
 
         if isinstance(response, LoginResponse):
-            self.matrix_domain = self.user_id.split(":")[-1]
+            self._set_identity(self.user_id)
 
         return response
 
@@ -325,9 +582,9 @@ class LocustClient(Client):
         Returns either 'LogoutResponse' if the request was successful or
         a `Logouterror` if there was an error with the request.
         """
-        method, path, data = self._build_request(Api.logout(self.access_token, all_devices))
+        method, path, data = self._build_client_request(_api_logout(self.access_token, all_devices))
 
-        response = self._send(LogoutResponse, method, path, data)
+        response = self._send(LogoutResponse, method, path, data, LABEL_LOGOUT)
 
         if isinstance(response, LogoutResponse):
             self.user_id = None
@@ -357,92 +614,86 @@ class LocustClient(Client):
 
         Returns a 'RegisterResponse' if successful.
         """
-        method, path, data = self._build_request(Api.register(
+        method, path, body = self._build_client_request(_api_register(
             user=username,
             password=password,
             device_name=device_name,
             device_id=self.device_id,
         ))
 
-        data = json.loads(data)
-
-        with self.locust_user.rest(method, path, json=data) as response1:
+        # The first attempt sends the body exactly as it was built
+        with self.locust_user.rest(method, path, data=body) as response1:
             if response1.status_code == HTTPStatus.OK: #200
-                logging.info("User [%s] Success!  Didn't even need UIAA!", self.user)
-                self.user_id = response1.js.get("user_id", None)
-                self.access_token = response1.js.get("access_token", None)
-                self.matrix_domain = self.user_id.split(":")[-1]
-                if self.user_id is None or self.access_token is None:
-                    logging.error("User [%s] Failed to parse /register response!\nResponse: %s", self.user, response1.js)
-                    return
-                self.locust_user.update_tokens()
+                logger.info("User [%s] Success!  Didn't even need UIAA!", self.user)
+                self._finalize_register(response1.js)
             elif response1.status_code == HTTPStatus.UNAUTHORIZED: #401
                 # Not an error, unauthorized requests are apart of the registration-flow
                 response1.success()
 
                 flows = response1.js.get("flows", None)
                 if flows is None:
-                    logging.error("User [%s] No UIAA flows for /register\nResponse: %s", self.user, response1.js)
+                    logger.error("User [%s] No UIAA flows for /register\nResponse: %s", self.user, _fmt_err(response1))
                     self.locust_user.environment.runner.quit()
                     return
 
+                # Only decode the body when the UIAA stages need to fill in its auth dict.
+                # It stays a dict from here on, and is re-encoded once per stage.
+                # The auth dict is built here rather than relying on the one Api.register added
+                data = json_loads(body)
                 session_id = response1.js.get("session", None)
                 if session_id is None:
-                    logging.info("User [%s] No session ID provided by server for /register", self.user)
+                    logger.info("User [%s] No session ID provided by server for /register", self.user)
+                    auth = {"type": "m.login.dummy"}
                 else:
-                    data["auth"]["session"] = session_id
+                    auth = {"type": "m.login.dummy", "session": session_id}
+                data["auth"] = auth
 
                 # Pick the first available login flow and attempt to use it
                 for flow in flows:
                     stages = flow.get("stages", [])
                     if len(stages) > 0:
-                        logging.info(f"Found UIAA flow [{', '.join(stages)}]")
+                        logger.info("Found UIAA flow [%s]", ", ".join(stages))
 
                         for stage in stages:
-                            data["auth"]["type"] = stage
-
-                            if stage == "m.login.dummy":
-                                pass
-                            elif stage == "m.login.password":
-                                data["auth"]["identifier"]["type"] = "m.id.user"
-                                data["auth"]["identifier"]["user"] = self.user
-                                data["auth"]["password"] = self.password
-                            elif stage == "m.login.registration_token":
-                                data["auth"]["token"] = token
-
-                            with self.locust_user.rest("POST", path, json=data) as response2:
-                                print(response2.js)
+                            auth["type"] = stage
+
+                            # Stages without a handler (e.g. m.login.dummy) only need the type
+                            stage_handler = REGISTER_STAGE_HANDLERS.get(stage)
+                            if stage_handler is not None:
+                                stage_handler(self, auth, token)
+
+                            with self.locust_user.rest("POST", path, data=json_dumps(data)) as response2:
                                 if response2.status_code == HTTPStatus.OK or response2.status_code == HTTPStatus.CREATED: # 200 or 201
-                                    logging.info("User [%s] Success!", self.user)
-                                    self.user_id = response2.js.get("user_id", None)
-                                    self.access_token = response2.js.get("access_token", None)
-                                    self.matrix_domain = self.user_id.split(":")[-1]
-                                    if self.user_id is None or self.access_token is None:
-                                        logging.error("User [%s] Failed to parse /register response!\nResponse: %s", self.user,
-                                                    response2.js)
-                                        return
-                                    self.locust_user.update_tokens()
+                                    logger.info("User [%s] Success!", self.user)
+                                    self._finalize_register(response2.js)
                                     return
                                 elif response2.status_code == HTTPStatus.UNAUTHORIZED: #401
                                     continue
                                 else:
-                                    logging.error("User[%s] /register failed with status code %d\nResponse: %s", self.user,
-                                            response2.status_code, response2.js)
+                                    logger.error("User[%s] /register failed with status code %d\nResponse: %s", self.user,
+                                            response2.status_code, _fmt_err(response2))
                                     break
             else:
-                logging.error("User[%s] /register failed with status code %d\nResponse: %s", self.user,
-                            response1.status_code, response1.js)
+                logger.error("User[%s] /register failed with status code %d\nResponse: %s", self.user,
+                            response1.status_code, _fmt_err(response1))
 
 
         #return await self._send(RegisterResponse, method, path, data)
 
+    def _finalize_register(self, js: Dict[str, Any]) -> bool:
+        """Takes on the identity from a successful /register response and reports the new tokens"""
+        if not self._apply_auth_response(js):
+            logger.error("User [%s] Failed to parse /register response!\nResponse: %s", self.user, js)
+            return False
+
+        self.locust_user.update_tokens()
+        return True
+
     def register_uia(self) -> None:
         """TODO: Update to make this a generic UIA handler that calls callbacks depending on stages
         rather than being circles flow specific"""
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        }
+        # Copied, since Locust adds its own headers to the dict it's given
+        headers = dict(JSON_HEADERS)
         path = "/_matrix/client/v3/register"
         url = self.locust_user.host + path
         session_id = ""
@@ -457,16 +708,16 @@ class LocustClient(Client):
 
 
         # Request 1: Empty #####################################################
-        with self.locust_user.client.request("POST", url, headers=headers, json={}, catch_response=True) as r1:
-            initial_json = r1.json()
-            session_id = r1.json().get("session", None)
+        with self.locust_user.client.request("POST", url, headers=headers, data="{}", catch_response=True) as r1:
+            initial_json = json_loads(r1.content or b"{}")
+            session_id = initial_json.get("session", None)
 
             # print("Got response: ", json.dumps(r1.js, indent=4))
             if r1.status_code == HTTPStatus.UNAUTHORIZED: #401
                 r1.success()
             else:
-                error = r1.json().get("error", "???")
-                errcode = r1.json().get("errcode", "???")
+                error = initial_json.get("error", "???")
+                errcode = initial_json.get("errcode", "???")
                 print(f"Got error response: {errcode} {error}")
                 return
 
@@ -478,15 +729,16 @@ class LocustClient(Client):
                 "session": session_id
             }
         }
-        with self.locust_user.client.request("POST", url, headers=headers, json=body, catch_response=True) as r3:
-            completed = r3.json().get("completed", [])
+        with self.locust_user.client.request("POST", url, headers=headers, data=json_dumps(body), catch_response=True) as r3:
+            r3_json = json_loads(r3.content or b"{}")
+            completed = r3_json.get("completed", [])
 
             # print("Got response: ", json.dumps(r3.js, indent=4))
             if r3.status_code == HTTPStatus.UNAUTHORIZED: #401
                 r3.success()
             else:
-                error = r3.json().get("error", "???")
-                errcode = r3.json().get("errcode", "???")
+                error = r3_json.get("error", "???")
+                errcode = r3_json.get("errcode", "???")
                 print(f"Got error response: {errcode} {error}")
                 return
 
@@ -498,22 +750,23 @@ class LocustClient(Client):
                 "username": self.user
             }
         }
-        with self.locust_user.client.request("POST", url, headers=headers, json=body, catch_response=True) as r4:
-            completed = r4.json().get("completed", [])
+        with self.locust_user.client.request("POST", url, headers=headers, data=json_dumps(body), catch_response=True) as r4:
+            r4_json = json_loads(r4.content or b"{}")
+            completed = r4_json.get("completed", [])
 
             # print("Got response: ", json.dumps(r4.js, indent=4))
             if r4.status_code == HTTPStatus.UNAUTHORIZED: #401
                 r4.success()
             else:
-                error = r4.json().get("error", "???")
-                errcode = r4.json().get("errcode", "???")
+                error = r4_json.get("error", "???")
+                errcode = r4_json.get("errcode", "???")
                 print(f"Got error response: {errcode} {error}")
                 return
 
         # Request 6: BS-SPEKE OPRF
         oprf_params = initial_json["params"]["m.enroll.bsspeke-ecc.oprf"]
         curve = oprf_params["curve"]
-        blind_base64 = binascii.b2a_base64(blind, newline=False).decode('utf-8')
+        blind_base64 = base64.b64encode(blind).decode('ascii')
 
         body = {
             "auth": {
@@ -524,16 +777,16 @@ class LocustClient(Client):
             }
         }
         bs_speke_params = None
-        with self.locust_user.client.request("POST", url, headers=headers, json=body, catch_response=True) as r6:
-            bs_speke_params = r6.json()
-            completed = r6.json().get("completed", [])
-            r6_params = r6.json().get("params", {})
+        with self.locust_user.client.request("POST", url, headers=headers, data=json_dumps(body), catch_response=True) as r6:
+            bs_speke_params = json_loads(r6.content or b"{}")
+            completed = bs_speke_params.get("completed", [])
+            r6_params = bs_speke_params.get("params", {})
 
             if r6.status_code == HTTPStatus.UNAUTHORIZED: #401
                 r6.success()
             else:
-                error = r6.json().get("error", "???")
-                errcode = r6.json().get("errcode", "???")
+                error = bs_speke_params.get("error", "???")
+                errcode = bs_speke_params.get("errcode", "???")
                 print(f"Got error response: {errcode} {error}")
                 return
             # print("OPRF success - Got response: ", json.dumps(r6.js, indent=4))
@@ -546,41 +799,39 @@ class LocustClient(Client):
             "iterations": 3,
             "blocks": 100000
         }
-        P,V = client.generate_P_and_V(base64.b64decode(blind_salt), phf_params)
+        # The argon2 PHF is run on the hub's threadpool, so the other users' greenlets
+        # keep making requests while this one waits on it
+        P,V = gevent.get_hub().threadpool.apply(client.generate_P_and_V,
+                                                (base64.b64decode(blind_salt), phf_params))
 
         body = {
             "username": self.user,
             "auth": {
                 "type": "m.enroll.bsspeke-ecc.save",
-                "P": binascii.b2a_base64(P, newline=False).decode('utf-8'),
-                "V": binascii.b2a_base64(V, newline=False).decode('utf-8'),
+                "P": base64.b64encode(P).decode('ascii'),
+                "V": base64.b64encode(V).decode('ascii'),
                 "phf_params": phf_params,
                 "session": session_id
             }
         }
         # with self.client.request("POST", url, headers=headers, json=body, catch_response=True) as r3:
-        with self.locust_user.rest("POST", url, headers=headers, json=body) as r7:
+        with self.locust_user.rest("POST", url, headers=headers, data=json_dumps(body)) as r7:
             completed = r7.js.get("completed", [])
             if r7.status_code != 200:
                 error = r7.js.get("error", "???")
                 errcode = r7.js.get("errcode", "???")
                 print("Got error response: %s %s" % (errcode, error))
-            print("Register success - Got response: ", json.dumps(r7.js, indent=4))
+            logger.debug("User [%s] Register success - Got response: %s", self.user, r7.js)
 
-            self.user_id = r7.js.get("user_id", None)
-            self.access_token = r7.js.get("access_token", None)
-            self.matrix_domain = self.user_id.split(":")[-1]
-            self.device_id = r7.js.get("device_id", None)
+            self._apply_auth_response(r7.js)
 
 
 
     def login_uia(self) -> None:
         """TODO: Update to make this a generic UIA handler that calls callbacks depending on stages
         rather than being circles flow specific"""
-        headers = {
-            'Content-Type': 'application/json',
-            'Accept': 'application/json'
-        }
+        # Copied, since Locust adds its own headers to the dict it's given
+        headers = dict(JSON_HEADERS)
         path = "/_matrix/client/v3/login"
         url = self.locust_user.host + path
         session_id = ""
@@ -600,16 +851,16 @@ class LocustClient(Client):
                 "user": self.user_id
             }
         }
-        with self.locust_user.client.request("POST", url, headers=headers, json=body, catch_response=True) as r1:
-            initial_json = r1.json()
-            session_id = r1.json().get("session", None)
+        with self.locust_user.client.request("POST", url, headers=headers, data=json_dumps(body), catch_response=True) as r1:
+            initial_json = json_loads(r1.content or b"{}")
+            session_id = initial_json.get("session", None)
 
             # print("Got response: ", json.dumps(r1.js, indent=4))
             if r1.status_code == HTTPStatus.UNAUTHORIZED: #401
                 r1.success()
             else:
-                error = r1.json().get("error", "???")
-                errcode = r1.json().get("errcode", "???")
+                error = initial_json.get("error", "???")
+                errcode = initial_json.get("errcode", "???")
                 print(f"Got error response: {errcode} {error}")
                 return
 
@@ -617,7 +868,7 @@ class LocustClient(Client):
         oprf_params = initial_json["params"]["m.login.bsspeke-ecc.oprf"]
         curve = oprf_params["curve"]
         phf_params = oprf_params["phf_params"]
-        blind_base64 = binascii.b2a_base64(blind, newline=False).decode('utf-8')
+        blind_base64 = base64.b64encode(blind).decode('ascii')
 
         body = {
             "identifier": {
@@ -632,15 +883,16 @@ class LocustClient(Client):
             }
         }
         r2_params = None
-        with self.locust_user.client.request("POST", url, headers=headers, json=body, catch_response=True) as r2:
-            completed = r2.json().get("completed", [])
-            r2_params = r2.json().get("params", {})
+        with self.locust_user.client.request("POST", url, headers=headers, data=json_dumps(body), catch_response=True) as r2:
+            r2_json = json_loads(r2.content or b"{}")
+            completed = r2_json.get("completed", [])
+            r2_params = r2_json.get("params", {})
 
             if r2.status_code == HTTPStatus.UNAUTHORIZED: #401
                 r2.success()
             else:
-                error = r2.json().get("error", "???")
-                errcode = r2.json().get("errcode", "???")
+                error = r2_json.get("error", "???")
+                errcode = r2_json.get("errcode", "???")
                 print(f"Got error response: {errcode} {error}")
                 return
 
@@ -651,15 +903,14 @@ class LocustClient(Client):
         B_str = verify_params["B"]
         blind_salt = base64.b64decode(blind_salt_str)
         B = base64.b64decode(B_str)
-        B_hex = binascii.b2a_hex(B).decode('utf-8')
 
-        A_bytes = client.generate_A(blind_salt, phf_params)
+        # Like in register_uia, run the argon2 PHF off of the event loop
+        A_bytes = gevent.get_hub().threadpool.apply(client.generate_A, (blind_salt, phf_params))
         client.derive_shared_key(B)
         verifier_bytes = client.generate_verifier()
 
-        A = binascii.b2a_base64(A_bytes, newline=False).decode('utf-8')
-        A_hex = binascii.b2a_hex(A_bytes).decode('utf-8')
-        verifier = binascii.b2a_base64(verifier_bytes, newline=False).decode('utf-8')
+        A = base64.b64encode(A_bytes).decode('ascii')
+        verifier = base64.b64encode(verifier_bytes).decode('ascii')
 
         body = {
             "identifier": {
@@ -673,7 +924,7 @@ class LocustClient(Client):
                 "session": session_id
             }
         }
-        with self.locust_user.rest("POST", url, headers=headers, json=body) as r3:
+        with self.locust_user.rest("POST", url, headers=headers, data=json_dumps(body)) as r3:
         # with self.client.request("POST", url, headers=headers, json=body, catch_response=True) as r3:
             completed = r3.js.get("completed", [])
             if r3.status_code != 200:
@@ -681,13 +932,10 @@ class LocustClient(Client):
                 errcode = r3.js.get("errcode", "???")
                 print(f"Got error response: {errcode} {error}")
                 return
-            print("Login success - Got response: ", json.dumps(r3.js, indent=4))
+            logger.debug("User [%s] Login success - Got response: %s", self.user, r3.js)
 
 
-            self.user_id = r3.js.get("user_id", None)
-            self.access_token = r3.js.get("access_token", None)
-            self.matrix_domain = self.user_id.split(":")[-1]
-            self.device_id = r3.js.get("device_id", None)
+            self._apply_auth_response(r3.js)
 
 
 
@@ -728,7 +976,7 @@ class LocustClient(Client):
 
         Raises `LocalProtocolError` if the client isn't logged in.
         """
-        uuid: Union[str, UUID] = tx_id or uuid4()
+        uuid: Union[str, UUID] = tx_id or new_txn_id()
 
         # if self.olm:
         #     try:
@@ -764,18 +1012,15 @@ class LocustClient(Client):
         #             # Encrypt our content and change the message type.
         #             message_type, content = self.encrypt(room_id, message_type, content)
 
-        method, path, data = self._build_request(Api.room_send(
-            self.access_token, room_id, message_type, content, uuid
-        ))
-        label = f"/_matrix/client/v3/rooms/_/send/{message_type}/_"
-        return self._send(RoomSendResponse, method, path, data, label, (room_id,))
+        return self._send_api(RoomSendResponse, send_label(message_type), (room_id,),
+                              _api_room_send, room_id, message_type, content, uuid)
 
     @logged_in
     def room_put_state(
         self,
         room_id: str,
         event_type: str,
-        content: Dict[Any, Any],
+        content: Union[Dict[Any, Any], str, bytes],
         state_key: str = "",
     ) -> Union[RoomPutStateResponse, RoomPutStateError]:
         """Send a state event to a room.
@@ -788,20 +1033,13 @@ class LocustClient(Client):
         Args:
             room_id (str): The room id of the room to send the event to.
             event_type (str): The type of the state to send.
-            content (Dict[Any, Any]): The content of the event to be sent.
+            content (Dict[Any, Any]): The content of the event to be sent, or
+                the content already encoded as JSON.
             state_key (str): The key of the state event to send.
         """
 
-        method, path, data = Api.room_put_state(
-            self.access_token,
-            room_id,
-            event_type,
-            content,
-            state_key=state_key,
-        )
-
-        label = f"/_matrix/client/v3/rooms/_/state/{event_type}/_"
-        return self._send(RoomPutStateResponse, method, path, data, label, (room_id,))
+        return self._send_api(RoomPutStateResponse, state_label(event_type), (room_id,),
+                              _api_room_put_state, room_id, event_type, content, state_key)
 
     @logged_in
     def room_get_state(
@@ -819,11 +1057,11 @@ class LocustClient(Client):
             room_id (str): The room id of the room to fetch state from.
         """
 
-        method, path = Api.room_get_state(
+        method, path = _api_room_get_state(
             self.access_token,
             room_id,
         )
-        label = "/_matrix/client/v3/rooms/_/state/"
+        label = LABEL_ROOM_STATE
         return self._send(RoomGetStateResponse, method, path, None, label, (room_id,))
 
     @logged_in
@@ -844,11 +1082,11 @@ class LocustClient(Client):
             state_key (str): The key of the state event to fetch.
         """
 
-        method, path = Api.room_get_state_event(
+        method, path = _api_room_get_state_event(
             self.access_token, room_id, event_type, state_key=state_key
         )
 
-        label = f"/_matrix/client/v3/rooms/_/state/{event_type}/_"
+        label = state_label(event_type)
         return self._send(RoomGetStateEventResponse,
             method,
             path,
@@ -864,14 +1102,14 @@ class LocustClient(Client):
     @logged_in
     def room_create(
         self,
-        visibility: RoomVisibility = RoomVisibility.private,
+        visibility: Union[RoomVisibility, str] = RoomVisibility.private,
         alias: Optional[str] = None,
         name: Optional[str] = None,
         topic: Optional[str] = None,
         room_version: Optional[str] = None,
         federate: bool = False,
         is_direct: bool = False,
-        preset: Optional[RoomPreset] = None,
+        preset: Union[RoomPreset, str, None] = None,
         invite: Sequence[str] = (),
         initial_state: Sequence[Dict[str, Any]] = (),
         power_level_override: Optional[Dict[str, Any]] = None,
@@ -941,7 +1179,7 @@ class LocustClient(Client):
             space (bool): Create as a Space (defaults to False).
         """
 
-        method, path, data = self._build_request(Api.room_create(
+        method, path, data = _api_room_create(
             self.access_token,
             visibility=visibility,
             alias=alias,
@@ -956,9 +1194,9 @@ class LocustClient(Client):
             power_level_override=power_level_override,
             predecessor=predecessor,
             space=space,
-        ))
+        )
 
-        return self._send(RoomCreateResponse, method, path, body=data)
+        return self._send(RoomCreateResponse, method, path, data, LABEL_CREATE_ROOM)
 
     @logged_in
     def join(self, room_id: str) -> Union[JoinResponse, JoinError]:
@@ -975,10 +1213,7 @@ class LocustClient(Client):
         Args:
             room_id: The room id or alias of the room to join.
         """
-        method, path, data = self._build_request(Api.join(self.access_token, room_id))
-
-        label = "/_matrix/client/v3/join/_"
-        return self._send(JoinResponse, method, path, body=data, name=label)
+        return self._send_api(JoinResponse, LABEL_JOIN, (), _api_join, room_id)
 
     @logged_in
     def room_messages(
@@ -1025,7 +1260,7 @@ class LocustClient(Client):
 
 
         """
-        method, path = self._build_request(Api.room_messages(
+        method, path = _api_room_messages(
             self.access_token,
             room_id,
             start,
@@ -1033,9 +1268,9 @@ class LocustClient(Client):
             direction=direction,
             limit=limit,
             message_filter=message_filter,
-        ))
+        )
 
-        label = "/_matrix/client/v3/rooms/_/messages"
+        label = LABEL_ROOM_MESSAGES
         return self._send(RoomMessagesResponse, method, path, None, label, (room_id,))
 
     @logged_in
@@ -1062,11 +1297,8 @@ class LocustClient(Client):
             timeout (int): For how long should the new typing notice be
                 valid for in milliseconds.
         """
-        method, path, data = self._build_request(Api.room_typing(
-            self.access_token, room_id, self.user_id, typing_state, timeout
-        ))
-        label = "/_matrix/client/v3/rooms/_/typing/_"
-        return self._send(RoomTypingResponse, method, path, data, label, (room_id,))
+        return self._send_api(RoomTypingResponse, LABEL_ROOM_TYPING, (room_id,),
+                              _api_room_typing, room_id, self.user_id, typing_state, timeout)
 
     @logged_in
     def room_get_tags(
@@ -1074,12 +1306,10 @@ class LocustClient(Client):
         room_id: str,
     ) -> Tuple[RoomGetTagsResponse, RoomGetTagsError]:
 
-        method, path, data = self._build_request(ApiExt.get_tags(
-            self.access_token, self.user_id, room_id
-        ))
+        method, path = _api_get_tags(self.access_token, self.user_id, room_id)
 
-        label = "/_matrix/client/v3/user/_/rooms/_/tags"
-        return self._send(RoomGetTagsResponse, method, path, data, label)
+        label = LABEL_ROOM_TAGS
+        return self._send(RoomGetTagsResponse, method, path, None, label)
 
     @logged_in
     def room_set_tags(
@@ -1089,11 +1319,9 @@ class LocustClient(Client):
         order: float = None,
     ) -> Tuple[RoomSetTagsResponse, RoomSetTagsError]:
 
-        method, path, data = self._build_request(ApiExt.set_tags(
-            self.access_token, self.user_id, room_id, tag, order
-        ))
+        method, path, data = _api_set_tags(self.access_token, self.user_id, room_id, tag, order)
 
-        label = "/_matrix/client/v3/user/_/rooms/_/tags"
+        label = LABEL_ROOM_TAGS
         return self._send(RoomSetTagsResponse, method, path, data, label)
 
 
@@ -1119,15 +1347,33 @@ class LocustClient(Client):
             receipt_type (str): The type of receipt to send. Currently, only
                 `m.read` is supported by the Matrix specification.
         """
-        method, path = self._build_request(Api.update_receipt_marker(
-            self.access_token,
-            room_id,
-            event_id,
-            receipt_type,
+        return self._send_api(UpdateReceiptMarkerResponse, LABEL_RECEIPT, (),
+                              _api_update_receipt_marker, room_id, event_id, receipt_type)
+
+    def get_profile(
+        self, user_id: Optional[str] = None
+    ) -> Union[ProfileGetResponse, ProfileGetError]:
+        """Get a user's combined profile information.
+
+        This queries the display name and avatar matrix content URI of a user
+        from the server in a single request, rather than one request for each.
+        The currently logged in user is queried if no user is specified.
+
+        Calls receive_response() to update the client state if necessary.
+
+        Returns either a `ProfileGetResponse` if the request was
+        successful or a `ProfileGetError` if there was an error
+        with the request.
+
+        Args:
+            user_id (str): User id of the user to get the profile for.
+        """
+        method, path = self._build_client_request(_api_profile_get(
+            user_id or self.user_id, access_token=self.access_token or None
         ))
 
-        label = "/_matrix/client/v3/rooms/_/receipt/m.read/_"
-        return self._send(UpdateReceiptMarkerResponse, method, path, "{}", label)
+        label = LABEL_PROFILE
+        return self._send(ProfileGetResponse, method, path, None, label)
 
     def get_displayname(
         self, user_id: Optional[str] = None
@@ -1146,11 +1392,11 @@ class LocustClient(Client):
         Args:
             user_id (str): User id of the user to get the display name for.
         """
-        method, path = self._build_request(Api.profile_get_displayname(
+        method, path = self._build_client_request(_api_profile_get_displayname(
             user_id or self.user_id, access_token=self.access_token or None
         ))
 
-        label = "/_matrix/client/v3/profile/_/displayname"
+        label = LABEL_DISPLAYNAME
         return self._send(ProfileGetDisplayNameResponse, method, path, None, label)
 
     @logged_in
@@ -1171,12 +1417,8 @@ class LocustClient(Client):
         Args:
             displayname (str): Display name to set.
         """
-        method, path, data = self._build_request(Api.profile_set_displayname(
-            self.access_token, self.user_id, displayname
-        ))
-
-        label = "/_matrix/client/v3/profile/_/displayname"
-        return self._send(ProfileSetDisplayNameResponse, method, path, data, label)
+        return self._send_api(ProfileSetDisplayNameResponse, LABEL_DISPLAYNAME, (),
+                              _api_profile_set_displayname, self.user_id, displayname)
 
     def get_avatar(
         self, user_id: Optional[str] = None
@@ -1195,11 +1437,11 @@ class LocustClient(Client):
         Args:
             user_id (str): User id of the user to get the avatar for.
         """
-        method, path = self._build_request(Api.profile_get_avatar(
+        method, path = self._build_client_request(_api_profile_get_avatar(
             user_id or self.user_id, access_token=self.access_token or None
         ))
 
-        label = "/_matrix/client/v3/profile/_/avatar_url"
+        label = LABEL_AVATAR_URL
         return self._send(ProfileGetAvatarResponse, method, path, None, label)
 
     @logged_in
@@ -1220,12 +1462,46 @@ class LocustClient(Client):
         Args:
             avatar_url (str): matrix content URI of the avatar to set.
         """
-        method, path, data = self._build_request(Api.profile_set_avatar(
-            self.access_token, self.user_id, avatar_url
+        return self._send_api(ProfileSetAvatarResponse, LABEL_AVATAR_URL, (),
+                              _api_profile_set_avatar, self.user_id, avatar_url)
+
+    def download(
+        self,
+        mxc: str,
+        filename: Optional[str] = None,
+        allow_remote: bool = True,
+    ) -> Union[DownloadResponse, DownloadError]:
+        """Get the content of a file from the content repository.
+
+        Unlike the other requests, the body is the file itself rather than
+        JSON, so it's sent here instead of through _send().
+
+        Returns either a `DownloadResponse` if the request was successful or
+        a `DownloadError` if there was an error with the request.
+
+        Args:
+            mxc (str): The mxc:// URI.
+            filename (str, optional): A filename to be returned in the response
+                by the server. If None (default), the original name of the
+                file will be returned instead, if there is one.
+            allow_remote (bool): Indicates to the server that it should not
+                attempt to fetch the media if it is deemed remote.
+        """
+        url = urlparse(mxc)
+        method, path = self._build_media_request(_api_download(
+            url.netloc, url.path.replace("/", ""), filename, allow_remote
         ))
 
-        label = "/_matrix/client/v3/profile/_/avatar_url"
-        return self._send(ProfileSetAvatarResponse, method, path, data, label)
+        with self._request(method, path, name=LABEL_DOWNLOAD, catch_response=True) as resp:
+            if resp.status_code == HTTPStatus.OK and resp.content is not None:
+                return DownloadResponse.from_data(resp.content, resp.headers.get("Content-Type"), filename)
+
+            try:
+                js = json_loads(resp.content or b"{}")
+            except ValueError:
+                js = {}
+            resp.failure(f"Could not download {mxc}, response code {resp.status_code}: {_fmt_err(resp)}")
+            return DownloadError.from_dict(js)
 
     @logged_in
     def sync(
@@ -1274,22 +1550,14 @@ class LocustClient(Client):
 
         sync_token = since or self.next_batch
         presence = set_presence #or self._presence
-        method, path = self._build_request(Api.sync(
+        method, path = _api_sync(
             self.access_token,
             since=sync_token or self.loaded_sync_token,
             timeout=timeout or None,
             filter=sync_filter,
             full_state=full_state,
             set_presence=presence,
-        ))
+        )
 
-        # response = await self._send(
-        #     SyncResponse,
-        #     method,
-        #     path,
-        #     # 0 if full_state: server doesn't respect timeout if full_state
-        #     # + 15: give server a chance to naturally return before we timeout
-        #     timeout=0 if full_state else timeout / 1000 + 15 if timeout else timeout,
-        # )
-        label = "/_matrix/client/v3/sync"
-        return self._send(SyncResponse, method, path, name=label)
+        label = LABEL_SYNC
+        return self._send(SyncResponse, method, path, None, label)
@@ -31,31 +31,19 @@
 #
 ###########################################################
 
-import csv
-import os
-import sys
-import glob
-import random
-import resource
-
-import json
 import logging
+from itertools import count
 
 import gevent
-from locust import task, tag, constant, between, TaskSet
+from locust import task, tag, constant
 from locust import events
 from locust.runners import MasterRunner, WorkerRunner
 
-from matrixuser import MatrixUser
-from nio import MatrixRoom, RoomMessageText
-from nio.responses import RoomSendError, RoomMessagesError, SyncError, LoginError
-
-from typing import Optional
+from matrix_locust.users.matrixuser import MatrixUser, load_users_csv, raise_file_limit, register_users_handler
 
 from nio.api import (
     RoomPreset,
     RoomVisibility,
-    _FilterT,
 )
 
 from nio import ChangeJoinRulesBuilder
@@ -64,29 +52,41 @@ from typing import (
     Any,
     Dict,
     List,
-    Tuple,
 )
 
-import time
+from matrix_locust.nio.contrib import EMPTY_JSON_BODY
+
+# Request bodies that are the same for every registration, so they're built
+# (and, where they're sent on their own, encoded) once instead of per room.
+# The join rules are complete state events, for the rooms' initial_state
+PRIVATE_JOIN_RULES = ChangeJoinRulesBuilder("private").as_dict()
+# spec says to use knock rule instead?
+INVITE_JOIN_RULES = ChangeJoinRulesBuilder("invite").as_dict()
+
+# temp rules dicts
+POWER_LEVELS_SPACE = {
+    "events_default": 100,
+}
+
+POWER_LEVELS_ROOM = {
+    "invite": 50,
+}
 
 # Preflight ###############################################
 
 @events.init.add_listener
 def on_locust_init(environment, **_kwargs):
     # Increase resource limits to prevent OS running out of descriptors
-    try:
-        resource.setrlimit(resource.RLIMIT_NOFILE, (999999, 999999))
-    except ValueError as e:
-        logging.warning(f"Failed to increase the resource limit: {e}")
+    raise_file_limit()
 
     # Multi-worker
     if isinstance(environment.runner, WorkerRunner):
         print(f"Registered 'load_users' handler on {environment.runner.client_id}")
-        environment.runner.register_message("load_users", CirclesUser.load_users)
+        register_users_handler(environment.runner, CirclesUser.load_users)
     # Single-worker
     elif not isinstance(environment.runner, WorkerRunner) and not isinstance(environment.runner, MasterRunner):
         # Open our list of users
-        CirclesUser.worker_users = csv.DictReader(open("users.csv"))
+        CirclesUser.set_worker_users(load_users_csv())
 
 ###########################################################
 
@@ -95,11 +95,28 @@ def on_locust_init(environment, **_kwargs):
 class CirclesUser(MatrixUser):
     wait_time = constant(0)
     worker_id = None
-    worker_users = []
+    # The users' credentials, as parallel columns rather than a dict per user
+    worker_usernames = ()
+    worker_passwords = ()
+    worker_users_index = count()
+
+    # Avatar URL (mxc://) set on each new account, none by default since
+    # registration doesn't upload any media
+    avatar_url = None
+
+    # Keep-alive connections in each user's pool, enough for the four rooms created
+    # concurrently during registration, each with up to two follow-up requests
+    concurrency = 8
+
+    @staticmethod
+    def set_worker_users(users):
+        CirclesUser.worker_usernames = tuple(user["username"] for user in users)
+        CirclesUser.worker_passwords = tuple(user["password"] for user in users)
+        CirclesUser.worker_users_index = count()
 
     @staticmethod
     def load_users(environment, msg, **_kwargs):
-        CirclesUser.worker_users = iter(msg.data)
+        CirclesUser.set_worker_users(msg.data)
         CirclesUser.worker_id = environment.runner.client_id
         logging.info("Worker [%s] Received %s users", environment.runner.client_id, len(msg.data))
 
@@ -114,16 +131,15 @@ class CirclesUser(MatrixUser):
         client_sleep = False
 
         # Load the next user
-        try:
-            user = next(CirclesUser.worker_users)
-        except StopIteration:
+        user_index = next(CirclesUser.worker_users_index)
+        if user_index >= len(CirclesUser.worker_usernames):
             # We can't shut down the worker until all users are registered, so return
             # early to stop this individual co-routine
             gevent.sleep(999999)
             return
 
-        self.matrix_client.user = user["username"]
-        self.matrix_client.password = user["password"]
+        self.matrix_client.user = CirclesUser.worker_usernames[user_index]
+        self.matrix_client.password = CirclesUser.worker_passwords[user_index]
 
         if self.matrix_client.user is None or self.matrix_client.password is None:
             logging.error("Couldn't get username/password. Skipping...")
@@ -139,32 +155,19 @@ class CirclesUser(MatrixUser):
         # * Displayname
         # * Avatar URL
         self.matrix_client.set_displayname(self.matrix_client.user)
-        self.matrix_client.set_avatar("")
-
-
-        private_rule = ChangeJoinRulesBuilder("private")
+        # Setting an empty avatar changes nothing, so only spend the request on a real one
+        if CirclesUser.avatar_url:
+            self.matrix_client.set_avatar(CirclesUser.avatar_url)
 
-        # # spec says to use knock rule instead?
-        # invite_rule = ChangeJoinRulesBuilder("invite")
 
         # re-add space content to tagging? think it uses canonical at least...
-        space_content = {
-            "canonical": True,
-            "via": [
-                "example.org",
-                "other.example.org"
-            ]
-        }
-
-
-        # temp rules dicts
-        power_levels_space_dict = {
-            "events_default": 100,
-        }
-
-        power_levels_dict = {
-            "invite": 50,
-        }
+        # space_content = {
+        #     "canonical": True,
+        #     "via": [
+        #         "example.org",
+        #         "other.example.org"
+        #     ]
+        # }
 
 
          # emulating android app with 1s delay
@@ -172,49 +175,42 @@ class CirclesUser(MatrixUser):
         # time.sleep(1)
 
         # Create Circles spaces hierarchy
-        root_room_id = self.create_room("Circles", None, None, None, "m.space",
-                                        "org.futo.space.root", None,
-                                        power_levels_space_dict, private_rule.as_dict())
-        if client_sleep:
-            gevent.sleep(1)
-
-        circles_room_id = self.create_room("My Circles", None, None, None, "m.space",
-                                           "org.futo.space.circles", root_room_id,
-                                           power_levels_space_dict, private_rule.as_dict())
+        root_room_id = self.create_space("Circles", None, None, None,
+                                         "org.futo.space.root", None,
+                                         POWER_LEVELS_SPACE, PRIVATE_JOIN_RULES)
         if client_sleep:
             gevent.sleep(1)
 
-        groups_room_id = self.create_room("My Groups", None, None, None, "m.space",
-                                          "org.futo.space.groups", root_room_id,
-                                          power_levels_space_dict, private_rule.as_dict())
-        if client_sleep:
-            gevent.sleep(1)
-
-        photos_room_id = self.create_room("My Photo Galleries", None, None, None, "m.space",
-                                          "org.futo.space.photos", root_room_id,
-                                          power_levels_space_dict, private_rule.as_dict())
+        # The top-level spaces only depend on the root space, so create them concurrently
+        circles_room, groups_room, photos_room = (
+            gevent.spawn(self.create_space, "My Circles", None, None, None,
+                         "org.futo.space.circles", root_room_id,
+                         POWER_LEVELS_SPACE, PRIVATE_JOIN_RULES),
+            gevent.spawn(self.create_space, "My Groups", None, None, None,
+                         "org.futo.space.groups", root_room_id,
+                         POWER_LEVELS_SPACE, PRIVATE_JOIN_RULES),
+            gevent.spawn(self.create_space, "My Photo Galleries", None, None, None,
+                         "org.futo.space.photos", root_room_id,
+                         POWER_LEVELS_SPACE, PRIVATE_JOIN_RULES),
+        )
+        gevent.joinall((circles_room, groups_room, photos_room), raise_error=True)
+        circles_room_id = circles_room.value
+        photos_room_id = photos_room.value
         if client_sleep:
             gevent.sleep(1)
 
 
         # "My People" and "User display name" spaces not created in android app?
 
-        # Create sub-space rooms
-        self.create_room("Photos", None, None, None, "org.futo.social.gallery",
+        # Create sub-space rooms, again concurrently since they only depend on their parent spaces
+        gevent.joinall((
+            gevent.spawn(self.create_room, "Photos", None, None, None,
                          "org.futo.social.gallery", photos_room_id,
-                         power_levels_dict, private_rule.as_dict())
-        if client_sleep:
-            gevent.sleep(1)
-
-        self.create_circle_with_timeline("Friends", None, circles_room_id)
-        if client_sleep:
-            gevent.sleep(1)
-
-        self.create_circle_with_timeline("Family", None, circles_room_id)
-        if client_sleep:
-            gevent.sleep(1)
-
-        self.create_circle_with_timeline("Community", None, circles_room_id)
+                         POWER_LEVELS_ROOM, PRIVATE_JOIN_RULES),
+            gevent.spawn(self.create_circle_with_timeline, "Friends", None, circles_room_id),
+            gevent.spawn(self.create_circle_with_timeline, "Family", None, circles_room_id),
+            gevent.spawn(self.create_circle_with_timeline, "Community", None, circles_room_id),
+        ), raise_error=True)
         if client_sleep:
             gevent.sleep(1)
 
@@ -223,91 +219,88 @@ class CirclesUser(MatrixUser):
 
     # modeled from android app
     def create_circle_with_timeline(self, name: str, icon_uri: str, space_parent_id: str) -> str:
-        # temp defines
-        power_levels_dict = {
-            "invite": 50,
-        }
-
-        # spec says to use knock rule instead?
-        invite_rule = ChangeJoinRulesBuilder("invite")
+        circle_room_id = self.create_space(name, None, icon_uri, None,
+                         "org.futo.social.circle", space_parent_id, POWER_LEVELS_ROOM,
+                         INVITE_JOIN_RULES)
 
-        circle_room_id = self.create_room(name, None, icon_uri, None, "m.space",
-                         "org.futo.social.circle", space_parent_id, power_levels_dict,
-                         invite_rule.as_dict())
-
-        self.create_room(name, None, icon_uri, None, "org.futo.social.timeline",
+        self.create_room(name, None, icon_uri, None,
                          "org.futo.social.timeline", circle_room_id,
-                         power_levels_dict, invite_rule.as_dict())
+                         POWER_LEVELS_ROOM, INVITE_JOIN_RULES)
 
         return circle_room_id
 
 
+    # modeled from android app
+    def create_space(self,
+                     name: str,
+                     topic: str,
+                     icon_uri: str,
+                     invite_ids: List[str],
+                     tag: str,
+                     space_parent_id: str,
+                     power_levels: Dict[str, int],
+                     join_rules: Dict[str, Any],
+                     ) -> str:
+        return self._create_room(name, topic, icon_uri, invite_ids, tag, space_parent_id,
+                                 power_levels, join_rules, is_space=True)
+
+
     # modeled from android app
     def create_room(self,
                     name: str,
                     topic: str,
                     icon_uri: str,
                     invite_ids: List[str],
-                    room_type: str,
                     tag: str,
                     space_parent_id: str,
                     power_levels: Dict[str, int],
                     join_rules: Dict[str, Any],
                     ) -> str:
-        # temp dict constants
-        power_levels_dict = {
-            "invite": 50,
-        }
-
-        is_space = False
-
-        # Other custom room types other than 'm.space' currently not supported
-        if room_type == "m.space":
-            is_space = True
+        # Plain rooms have no room type, spaces are created with create_space instead
+        return self._create_room(name, topic, icon_uri, invite_ids, tag, space_parent_id,
+                                 power_levels, join_rules, is_space=False)
+
+
+    def _create_room(self,
+                     name: str,
+                     topic: str,
+                     icon_uri: str,
+                     invite_ids: List[str],
+                     tag: str,
+                     space_parent_id: str,
+                     power_levels: Dict[str, int],
+                     join_rules: Dict[str, Any],
+                     is_space: bool,
+                     ) -> str:
+        # The new room's own state is sent along with /createRoom, rather than
+        # as separate requests once it exists
+        initial_state = [join_rules]
+        if not(space_parent_id is None):
+            initial_state.append({"type": "m.space.parent", "state_key": space_parent_id, "content": {}})
 
         request = self.matrix_client.room_create(
             visibility=RoomVisibility.private,
             name=name,
             topic=topic,
             preset=RoomPreset.private_chat,
+            initial_state=initial_state,
             power_level_override=power_levels,
             space=is_space
         )
 
-        self.matrix_client.room_set_tags(request.room_id, tag)
-        self.matrix_client.room_put_state(request.room_id, "m.room.join_rules", join_rules)
+        # Only the tag and the parent's side of the space link are left, and
+        # they don't depend on each other
+        followups = [gevent.spawn(self.matrix_client.room_set_tags, request.room_id, tag)]
 
         if not(space_parent_id is None):
-            self.matrix_client.room_put_state(request.room_id, "m.space.parent", {}, space_parent_id)
-            self.matrix_client.room_put_state(space_parent_id, "m.space.child", {}, request.room_id)
+            followups.append(gevent.spawn(self.matrix_client.room_put_state,
+                                          space_parent_id, "m.space.child", EMPTY_JSON_BODY, request.room_id))
+        gevent.joinall(followups, raise_error=True)
         # todo: enable room encryption?
 
         return request.room_id
 
 
-
-        # power levels dict not added to room builder yet...
-        # object Admin : Role(100)
-        # object Moderator : Role(50)
-        # object Default : Role(0)
-
-        #   "content": {
-        #     "ban": 50,
-        #     "events": {
-        #     "m.room.name": 100,
-        #     "m.room.power_levels": 100
-        #     },
-        #     "events_default": 0,
-        #     "invite": 50,
-        #     "kick": 50,
-        #     "notifications": {
-        #     "room": 20
-        #     },
-        #     "redact": 50,
-        #     "state_default": 50,
-        #     "users": {
-        #     "@example:localhost": 100
-        #     },
-        #     "users_default": 0
-        # },
-
+        # power levels dict not added to room builder yet, see the Android app's
+        # roles (Admin: 100, Moderator: 50, Default: 0) and the m.room.power_levels
+        # content in https://spec.matrix.org/latest/client-server-api/#mroompower_levels
@@ -27,29 +27,35 @@
 #
 ###########################################################
 
-import csv
 import os
 import sys
-import glob
+import math
 import random
-import resource
+import time
 
 import json
 import logging
+from collections import defaultdict, deque
+from functools import partial
 
 import gevent
+from gevent.pool import Pool
 from locust import task, between, TaskSet
 from locust import events
+from locust.exception import StopUser
 from locust.runners import MasterRunner, WorkerRunner
 
-from matrix_locust.users.matrixuser import MatrixUser
-from nio import MatrixRoom, RoomMessageText
+from matrix_locust.users.matrixuser import MatrixUser, iter_users_csv, raise_file_limit, register_users_handler
+from matrix_locust.nio.contrib import json_dumps
+from nio import RoomMessageText
 from nio.responses import (
     LoginError,
     SyncError,
+    SyncResponse,
     RoomSendError,
     RoomMessagesError,
     ProfileSetDisplayNameError,
+    ProfileGetResponse,
 )
 
 from typing import Optional
@@ -62,44 +68,106 @@ from nio.api import _FilterT
 @events.init.add_listener
 def on_locust_init(environment, **_kwargs):
     # Increase resource limits to prevent OS running out of descriptors
-    try:
-        resource.setrlimit(resource.RLIMIT_NOFILE, (999999, 999999))
-    except ValueError as e:
-        logging.warning(f"Failed to increase the resource limit: {e}")
+    raise_file_limit()
 
     # Multi-worker
     if isinstance(environment.runner, WorkerRunner):
         print(f"Registered 'load_users' handler on {environment.runner.client_id}")
-        environment.runner.register_message("load_users", MatrixChatUser.load_users)
+        register_users_handler(environment.runner, MatrixChatUser.load_users)
     # Single-worker
     elif not isinstance(environment.runner, WorkerRunner) and not isinstance(environment.runner, MasterRunner):
         # Open our list of users
-        MatrixChatUser.worker_users = csv.DictReader(open("users.csv"))
+        MatrixChatUser.worker_users = iter_users_csv()
+
+def _scan_folder(folder, suffix=""):
+    """Lists the entries in folder ending in suffix with one directory read, like glob's "*suffix"
 
-# Load our images and thumbnails
+    A missing folder has no entries, again like glob
+    """
+    try:
+        with os.scandir(folder) as entries:
+            return tuple(entry for entry in entries if entry.name.endswith(suffix) and entry.name[:1] != ".")
+    except FileNotFoundError:
+        return ()
+
+# Load our images and thumbnails, once for all users
 images_folder = "images"
-image_files = glob.glob(os.path.join(images_folder, "*.jpg"))
-images_with_thumbnails = []
-for image_filename in image_files:
-    image_basename = os.path.basename(image_filename)
-    thumbnail_filename = os.path.join(images_folder, "thumbnails", image_basename)
-    if os.path.exists(thumbnail_filename):
-        images_with_thumbnails.append(image_filename)
+image_entries = _scan_folder(images_folder, ".jpg")
+image_files = tuple(entry.path for entry in image_entries)
+# One pass over the thumbnails folder, instead of a stat for every image
+thumbnail_names = frozenset(entry.name for entry in _scan_folder(os.path.join(images_folder, "thumbnails")))
+images_with_thumbnails = tuple(entry.path for entry in image_entries if entry.name in thumbnail_names)
 
 # Find our user avatar images
-avatars = []
 avatars_folder = "avatars"
-avatar_files = glob.glob(os.path.join(avatars_folder, "*.png"))
+avatar_files = tuple(entry.path for entry in _scan_folder(avatars_folder, ".png"))
 
 # Pre-generate some messages for the users to send
 lorem_ipsum_text = """
 Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris nisi ut aliquip ex ea commodo consequat. Duis aute irure dolor in reprehenderit in voluptate velit esse cillum dolore eu fugiat nulla pariatur. Excepteur sint occaecat cupidatat non proident, sunt in culpa qui officia deserunt mollit anim id est laborum.
 """
 lorem_ipsum_words = lorem_ipsum_text.split()
-
-lorem_ipsum_messages = {}
-for i in range(1, len(lorem_ipsum_words)+1):
-    lorem_ipsum_messages[i] = " ".join(lorem_ipsum_words[:i])
+MAX_MESSAGE_WORDS = len(lorem_ipsum_words)
+
+# Indexed by the number of words in the message, index 0 isn't used
+lorem_ipsum_messages = tuple(" ".join(lorem_ipsum_words[:i]) for i in range(len(lorem_ipsum_words)+1))
+# The m.text event content for each message, shared by every send since it's never modified
+lorem_ipsum_contents = tuple({"msgtype": "m.text", "body": message} for message in lorem_ipsum_messages)
+
+def _lognormal_cdf(x, mu=1.0, sigma=1.0):
+    return 0.5 * (1.0 + math.erf((math.log(x) - mu) / (sigma * math.sqrt(2.0))))
+
+# The message length is round(lognormvariate(1.0, 1.0)), clamped to [1, MAX_MESSAGE_WORDS].
+# Its distribution is worked out once, so each send is a single weighted draw over the
+# contents. Index 0 gets no weight, the clamps fold both tails into the end lengths
+message_cum_weights = tuple(
+    0.0 if i == 0 else 1.0 if i == MAX_MESSAGE_WORDS else _lognormal_cdf(i + 0.5)
+    for i in range(MAX_MESSAGE_WORDS + 1))
+
+# Number of the most recent messages in each room that the user looks at and reacts to
+RECENT_MESSAGES_COUNT = 10
+
+# Only ask /sync for what the user actually looks at: the recent messages in each room.
+# Encoded once, since the same filter goes out with every /sync
+SYNC_FILTER = json_dumps({
+    "room": {
+        "timeline": {"limit": RECENT_MESSAGES_COUNT},
+        "state": {"lazy_load_members": True},
+        "ephemeral": {"types": []},
+        "account_data": {"types": []},
+    },
+    "presence": {"types": []},
+    "account_data": {"types": []},
+})
+
+# Reactions the users pick from
+REACTIONS = ("💩", "👍", "❤️", "👎", "🤯", "😱", "👏")
+
+# Rate of the waits between actions while chatting in a room, expected value = 25 seconds
+CHAT_WAIT_RATE = 1.0 / 25.0
+
+# Login attempts per user, and the most seconds to back off between them
+LOGIN_ATTEMPTS = 5
+LOGIN_BACKOFF_MAX = 30.0
+
+# Most seconds each user waits before its first /sync, up to the long-poll timeout
+SYNC_START_SPREAD = 30.0
+
+# Seconds before looking up a profile again, when it didn't have an avatar or displayname
+PROFILE_MISS_TTL = 600
+
+# Most profiles each user remembers, the oldest lookups are dropped past this
+PROFILE_CACHE_SIZE = 1024
+
+def _cache_put(cache, key, value):
+    """Stores key in the bounded, insertion-ordered cache dict as its newest entry"""
+    cache.pop(key, None)
+    cache[key] = value
+    if len(cache) > PROFILE_CACHE_SIZE:
+        del cache[next(iter(cache))]
+
+# Chance of the user idling through another of its turns, rather than doing something
+DO_NOTHING_PROBABILITY = 23 / 34
 
 ###########################################################
 
@@ -109,6 +177,27 @@ class MatrixChatUser(MatrixUser):
     worker_id = None
     worker_users = []
 
+    # Number of profiles each user fetches concurrently, enough for all the senders of the recent messages
+    profile_concurrency = RECENT_MESSAGES_COUNT
+    # Keep-alive connections in each user's pool, for the profile fetches plus the /sync long-poll
+    concurrency = profile_concurrency + 1
+
+    def wait_time(self):
+        return random.expovariate(0.1) + self.do_nothing_time()
+
+    @staticmethod
+    def do_nothing_time():
+        """Time the user would have spent in the old do_nothing task before its next real task
+
+        do_nothing was weighted 23 against the other tasks' 11 and only waited. Each time it
+        would have been picked, the user waited twice (once in the task and once after it),
+        so that much is added to the wait instead of running the task
+        """
+        wait = 0.0
+        while random.random() < DO_NOTHING_PROBABILITY:
+            wait += random.gammavariate(2.0, 10.0)
+        return wait
+
     @staticmethod
     def load_users(environment, msg, **_kwargs):
         MatrixChatUser.worker_users = iter(msg.data)
@@ -118,23 +207,27 @@ class MatrixChatUser(MatrixUser):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.room_messages = {}
-        self.recent_messages = {}
+        # Only the most recent messages in each room are kept, older ones fall off the front
+        self.recent_messages = defaultdict(partial(deque, maxlen=RECENT_MESSAGES_COUNT))
         self.earliest_sync_tokens = {}
         self.user_avatar_urls = {}
         self.user_display_names = {}
+        # When we last fetched the profiles that came back without an avatar or displayname
+        self.profile_miss_times = {}
         self.matrix_sync_task = None
         self.initial_sync_token = None
-
-        self.matrix_client.add_event_callback(self.message_callback, RoomMessageText)
+        # Template for the generated displaynames, with the number at the end of the username filled in
+        self.displayname_format = None
+        # Snapshot of the client's room ids to pick random rooms from, see get_random_roomid()
+        self.room_ids = ()
 
     def on_start(self):
         # Load the next user who needs to be logged-in
         try:
             user = next(MatrixChatUser.worker_users)
         except StopIteration:
-            gevent.sleep(999999)
-            return
+            # No users left to log in, so end this user instead of parking its greenlet
+            raise StopUser()
 
         # Change to force user login request and refresh tokens
         invalidate_access_tokens = False
@@ -145,6 +238,9 @@ class MatrixChatUser(MatrixUser):
             logging.error("Couldn't get username/password. Skipping...")
             return
 
+        user_number = self.matrix_client.user.rsplit(".", 1)[-1]
+        self.displayname_format = "User %s (random=%%d)" % user_number.replace("%", "%%")
+
         if invalidate_access_tokens:
             self.matrix_client.user_id = None
             self.matrix_client.access_token = None
@@ -152,31 +248,43 @@ class MatrixChatUser(MatrixUser):
         # Log in as this current user if not already logged in
         if self.matrix_client.user_id is None or self.matrix_client.access_token is None or \
             len(self.matrix_client.user_id) < 1 or len(self.matrix_client.access_token) < 1:
-
-            while True:
+            for attempt in range(1, LOGIN_ATTEMPTS + 1):
                 response = self.matrix_client.login(self.matrix_client.password)
 
-                if isinstance(response, LoginError):
-                    logging.error("Login failed for User [%s]", self.matrix_client.user)
-                    return
-                else:
+                if not isinstance(response, LoginError):
                     break
+                logging.error("Login failed for User [%s] (attempt %d)", self.matrix_client.user, attempt)
+                # Back off, with some jitter, so failing logins don't hammer the server in step
+                if attempt < LOGIN_ATTEMPTS:
+                    gevent.sleep(min(LOGIN_BACKOFF_MAX, 0.5 * 2 ** attempt) + random.random())
+            else:
+                return
 
-        # Spawn a Greenlet to act as this user's client, constantly /sync'ing with the server
-        self.matrix_sync_task = gevent.spawn(self.sync_forever, client_sleep=None, timeout=30_000)
+        # Spawn a Greenlet to act as this user's client, constantly /sync'ing with the server.
+        # Its start is spread out, so the users' long-polls don't all come back around in step
+        self.matrix_sync_task = gevent.spawn_later(random.uniform(0, SYNC_START_SPREAD), self.sync_forever,
+                                                   client_sleep=None, timeout=30_000, sync_filter=SYNC_FILTER)
 
         # Wait a bit before we take our first action
         self.wait()
 
     def on_stop(self):
-        pass
+        # The sync greenlet isn't part of the user, so Locust won't stop it for us
+        if self.matrix_sync_task is not None:
+            self.matrix_sync_task.kill(block=False)
+            self.matrix_sync_task = None
         # Currently we don't want to invalidate access tokens stored in the csv file
         # self.logout()
 
     def get_random_roomid(self):
-        if len(self.matrix_client.rooms) > 0:
-            room_id = random.choice(list(self.matrix_client.rooms.keys()))
-            return room_id
+        # /sync only ever adds rooms to the client (we never forget any), so the
+        # snapshot is only rebuilt when the number of rooms has changed
+        rooms = self.matrix_client.rooms
+        if len(self.room_ids) != len(rooms):
+            self.room_ids = tuple(rooms)
+
+        if len(self.room_ids) > 0:
+            return self.room_ids[random.randrange(len(self.room_ids))]
         else:
             return None
 
@@ -200,25 +308,28 @@ class MatrixChatUser(MatrixUser):
 
         # Load the avatars for recent users
         # Load the thumbnails for any messages that have one
-        messages = self.recent_messages.get(room_id, [])
-
-        for message in messages:
-            sender_userid = message.sender
-            sender_avatar_mxc = self.user_avatar_urls.get(sender_userid, None)
-            if sender_avatar_mxc is None:
-                # FIXME Fetch the avatar URL for sender_userid
-                # FIXME Set avatar_mxc
-                # FIXME Set self.user_avatar_urls[sender_userid]
-                self.matrix_client.get_avatar(sender_userid)
-            # Try again.  Maybe we were able to populate the cache in the line above.
-            sender_avatar_mxc = self.user_avatar_urls.get(sender_userid, None)
-            # Now avatar_mxc might not be None, even if it was above
-            if sender_avatar_mxc is not None and len(sender_avatar_mxc) > 0:
-                # FIXME Reimplement method with nio after avatar support is added
-                self.download_matrix_media(sender_avatar_mxc)
-            sender_displayname = self.user_display_names.get(sender_userid, None)
-            if sender_displayname is None:
-                sender_displayname = self.matrix_client.get_displayname(sender_userid)
+        # Snapshot the messages, the sync greenlet can add more while we wait on the profile requests
+        messages = tuple(self.recent_messages.get(room_id, ()))
+
+        # Fetch the profiles of all the senders we don't know yet at once, each only once.
+        # Profiles that were missing something are only looked up again after a while
+        now = time.monotonic()
+        unknown_senders = {message.sender for message in messages
+                           if (message.sender not in self.user_avatar_urls
+                               or message.sender not in self.user_display_names)
+                           and now - self.profile_miss_times.get(message.sender, -PROFILE_MISS_TTL) >= PROFILE_MISS_TTL}
+        if unknown_senders:
+            Pool(MatrixChatUser.profile_concurrency).map(self.load_profile, unknown_senders)
+
+        # Maybe we were able to populate the cache in the lines above.
+        # Each sender's avatar is only loaded once, however many of the messages they sent
+        sender_avatar_mxcs = {self.user_avatar_urls.get(sender_userid) for sender_userid in
+                              {message.sender for message in messages}}
+        sender_avatar_mxcs.discard(None)
+        sender_avatar_mxcs.discard("")
+        # Download all of the avatars at once, now that we know them
+        if sender_avatar_mxcs:
+            Pool(MatrixChatUser.profile_concurrency).map(self.matrix_client.download, sender_avatar_mxcs)
 
         # Currently users only send text messages
         # for message in messages:
@@ -227,7 +338,22 @@ class MatrixChatUser(MatrixUser):
         #     if msgtype in ["m.image", "m.video", "m.file"]:
         #         thumb_mxc = message.content.get("thumbnail_url", None)
         #         if thumb_mxc is not None:
-        #             self.download_matrix_media(thumb_mxc)
+        #             self.matrix_client.download(thumb_mxc)
+
+
+    def load_profile(self, user_id):
+        # Fetch the avatar URL and displayname for user_id together
+        response = self.matrix_client.get_profile(user_id)
+        if isinstance(response, ProfileGetResponse):
+            if response.avatar_url is not None:
+                _cache_put(self.user_avatar_urls, user_id, response.avatar_url)
+            if response.displayname is not None:
+                _cache_put(self.user_display_names, user_id, response.displayname)
+
+        if user_id in self.user_avatar_urls and user_id in self.user_display_names:
+            self.profile_miss_times.pop(user_id, None)
+        else:
+            _cache_put(self.profile_miss_times, user_id, time.monotonic())
 
 
     def sync_forever(
@@ -244,8 +370,10 @@ class MatrixChatUser(MatrixUser):
         # Continually call the /sync endpoint
         # Put anything that the user might care about into our instance variables where the
         # user @task's can find it
+        # The client isn't replaced while this greenlet runs, so look up its sync method once
+        sync = self.matrix_client.sync
         while True:
-            response = self.matrix_client.sync(timeout, sync_filter, since, full_state, set_presence)
+            response = sync(timeout, sync_filter, since, full_state, set_presence)
 
             if isinstance(response, SyncError):
                 logging.error("[%s] /sync error (%s): %s",
@@ -253,24 +381,20 @@ class MatrixChatUser(MatrixUser):
             else:
                 if self.initial_sync_token is None:
                     self.initial_sync_token = response.next_batch
+                self.store_recent_messages(response)
 
             if not(client_sleep is None):
                 gevent.sleep(client_sleep)
 
-    def message_callback(self, room: MatrixRoom, event: RoomMessageText) -> None:
-        # Add the new messages to whatever we had before (if anything)
-        if self.room_messages.get(room.room_id) is None:
-            self.room_messages[room.room_id] = []
-        self.room_messages[room.room_id].append(event)
-
-        # Store only the most recent 10 messages, regardless of how many we had before or how many we just received
-        self.recent_messages[room.room_id] = self.room_messages[room.room_id][-10:]
+    def store_recent_messages(self, response: SyncResponse) -> None:
+        # Read the messages straight from the joined rooms' timelines, rather than having nio
+        # run an event callback for every event in every room
+        for room_id, join_info in response.rooms.join.items():
+            # Store only the most recent messages, regardless of how many we had before or how many we just received
+            self.recent_messages[room_id].extend(
+                event for event in join_info.timeline.events if isinstance(event, RoomMessageText))
 
 
-    @task(23)
-    def do_nothing(self):
-        self.wait()
-
     @task(1)
     def send_text(self):
         room_id = self.get_random_roomid()
@@ -279,20 +403,17 @@ class MatrixChatUser(MatrixUser):
             return
         #logging.info("User [%s] sending a message to room [%s]" % (self.username, room_id))
 
+        self._send_text(room_id)
+
+    def _send_text(self, room_id):
+        """Types and sends a random m.text message, shared by both send_text tasks"""
         # Send the typing notification like a real client would
         self.matrix_client.room_typing(room_id, True)
         # Sleep while we pretend the user is banging on the keyboard
         delay = random.expovariate(1.0 / 5.0)
         gevent.sleep(delay)
 
-        message_len = round(random.lognormvariate(1.0, 1.0))
-        message_len = min(message_len, len(lorem_ipsum_words))
-        message_len = max(message_len, 1)
-        message_text = lorem_ipsum_messages[message_len]
-        message_content = {
-            "msgtype": "m.text",
-            "body": message_text,
-        }
+        message_content = random.choices(lorem_ipsum_contents, cum_weights=message_cum_weights)[0]
 
         response = self.matrix_client.room_send(room_id, "m.room.message", message_content)
         if isinstance(response, RoomSendError):
@@ -308,10 +429,11 @@ class MatrixChatUser(MatrixUser):
 
         self.load_data_for_room(room_id)
 
-        if len(self.recent_messages.get(room_id, [])) < 1:
+        messages = self.recent_messages.get(room_id)
+        if not messages:
             return
 
-        event_id = self.recent_messages[room_id][-1].event_id
+        event_id = messages[-1].event_id
         self.matrix_client.update_receipt_marker(room_id, event_id)
 
 
@@ -344,9 +466,8 @@ class MatrixChatUser(MatrixUser):
 
     @task(1)
     def change_displayname(self):
-        user_number = self.matrix_client.user.split(".")[-1]
         random_number = random.randint(1,1000)
-        new_name = "User %s (random=%d)" % (user_number, random_number)
+        new_name = self.displayname_format % random_number
 
         response = self.matrix_client.set_displayname(new_name)
         if isinstance(response, ProfileSetDisplayNameError):
@@ -358,43 +479,29 @@ class MatrixChatUser(MatrixUser):
     class ChatInARoom(TaskSet):
 
         def wait_time(self):
-            expected_wait = 25.0
-            rate = 1.0 / expected_wait
-            return random.expovariate(rate)
+            return random.expovariate(CHAT_WAIT_RATE)
 
         def on_start(self):
             #logging.info("User [%s] chatting in a room" % self.user.username)
-            if len(self.user.matrix_client.rooms.keys()) == 0:
-                self.interrupt()
-            else:
-                self.room_id = self.user.get_random_roomid()
-                self.reacted_messages = []
-
-                if self.room_id is None:
-                    self.interrupt()
-                else:
-                    self.user.load_data_for_room(self.room_id)
+            # get_random_roomid only comes back empty when the user isn't in any rooms
+            self.room_id = self.user.get_random_roomid()
+            if self.room_id is None:
+                self.end_session()
+
+            self.reacted_messages = set()
+
+            # Each time we create a new instance of this task, we want to have the user
+            # generate a slightly different expected number of messages, so the weights
+            # are drawn here rather than once for the class
+            self.tasks = [self.send_text] * max(1, round(random.gauss(15,4))) \
+                + [self.send_image] * random.choice((0,0,0,1,1,2)) \
+                + [self.send_reaction] * random.choice((0,0,1,1,1,2,3)) \
+                + [self.stop]
+            self.user.load_data_for_room(self.room_id)
 
         @task
         def send_text(self):
-            # Send the typing notification like a real client would
-            self.user.matrix_client.room_typing(self.room_id, True)
-            # Sleep while we pretend the user is banging on the keyboard
-            delay = random.expovariate(1.0 / 5.0)
-            gevent.sleep(delay)
-
-            message_len = round(random.lognormvariate(1.0, 1.0))
-            message_len = min(message_len, len(lorem_ipsum_words))
-            message_len = max(message_len, 1)
-            message_text = lorem_ipsum_messages[message_len]
-            message_content = {
-                "msgtype": "m.text",
-                "body": message_text,
-            }
-
-            response = self.user.matrix_client.room_send(self.room_id, "m.room.message", message_content)
-            if isinstance(response, RoomSendError):
-                logging.error("[%s] failed to send/chat in room [%s]", self.user.matrix_client.user, self.room_id)
+            self.user._send_text(self.room_id)
 
         @task
         def send_image(self):
@@ -410,11 +517,21 @@ class MatrixChatUser(MatrixUser):
         def send_reaction(self):
             # Pick a recent message from the selected room,
             # and react to it
-            if len(self.user.recent_messages.get(self.room_id, [])) < 1:
+            messages = self.user.recent_messages.get(self.room_id)
+            if not messages:
                 return
 
-            message = random.choice(self.user.recent_messages[self.room_id])
-            reaction = random.choice(["💩","👍","❤️", "👎", "🤯", "😱", "👏"])
+            message = messages[random.randrange(len(messages))]
+            reaction = REACTIONS[random.randrange(len(REACTIONS))]
+
+            # Prevent errors with reacting to the same message with the same reaction
+            reacted_key = (message.event_id, reaction)
+            if reacted_key in self.reacted_messages:
+                return
+            else:
+                self.reacted_messages.add(reacted_key)
+
+            # Only built once we know the reaction is going to be sent
             content = {
                 "m.relates_to": {
                     "rel_type": "m.annotation",
@@ -423,12 +540,6 @@ class MatrixChatUser(MatrixUser):
                 }
             }
 
-            # Prevent errors with reacting to the same message with the same reaction
-            if (message, reaction) in self.reacted_messages:
-                return
-            else:
-                self.reacted_messages.append((message, reaction))
-
             # logging.info("[%s] sending reaction %s to message %s in room %s with event %s",
             #              self.user.matrix_client.user, reaction, message, self.room_id, message.event_id)
             response = self.user.matrix_client.room_send(self.room_id, "m.reaction", content)
@@ -440,14 +551,10 @@ class MatrixChatUser(MatrixUser):
         @task
         def stop(self):
             #logging.info("User [%s] stopping chat in room [%s]" % (self.user.username, self.room_id))
-            self.interrupt()
+            self.end_session()
 
-        # Each time we create a new instance of this task, we want to have the user
-        # generate a slightly different expected number of messages.
-        # FIXME Hmmm this doesn't seem to work...
-        tasks = {
-            send_text: max(1, round(random.gauss(15,4))),
-            send_image: random.choice([0,0,0,1,1,2]),
-            send_reaction: random.choice([0,0,1,1,1,2,3]),
-            stop: 1,
-        }
+        def end_session(self):
+            # interrupt() goes straight on to the user's next task without calling wait_time(),
+            # so the idle time from any do_nothing picks has to be spent here instead
+            gevent.sleep(self.user.do_nothing_time())
+            self.interrupt()
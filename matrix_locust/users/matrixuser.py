@@ -32,6 +32,7 @@ import mimetypes
 
 from locust import task, between, TaskSet, FastHttpUser
 from locust import events
+from locust.rpc import Message
 from locust.runners import MasterRunner, WorkerRunner
 from collections import namedtuple
 
@@ -45,39 +46,97 @@ from typing import Dict
 
 tokens_dict = {}
 if os.path.exists("tokens.csv"):
-    with open("tokens.csv", "r", encoding="utf-8") as csvfile:
-        csv_header = ["username", "user_id", "access_token", "next_batch"]
-        tokens_dict = { row["username"]: { "user_id": row["user_id"],
-                                        "access_token": row["access_token"],
-                                        "next_batch": row["next_batch"] }
-                    for row in csv.DictReader(csvfile, fieldnames=csv_header) }
-        tokens_dict.pop("username") # Dict includes the header values, so remove it
+    with open("tokens.csv", "r", encoding="utf-8", newline="") as csvfile:
+        # Columns are username, user_id, access_token, next_batch, as written by on_test_stop()
+        token_rows = csv.reader(csvfile)
+        next(token_rows, None) # Skip the header
+        tokens_dict = { username: { "user_id": user_id, "access_token": access_token, "next_batch": next_batch }
+                        for (username, user_id, access_token, next_batch) in token_rows }
 
 locust_users = []
 
+# /sync token updates waiting to go to the master, keyed by username so only each user's latest is sent.
+# Registrations and logins are sent straight away, so a test ending with a quit, where the
+# master writes tokens.csv before the workers stop, only loses the latest next_batch tokens
+pending_token_updates = {}
+# Seconds between sending the batched token updates
+TOKEN_FLUSH_INTERVAL = 5.0
+token_flush_greenlet = None
+
+# Number of users in each message from the master to a worker
+USERS_CHUNK_SIZE = 1000
+
+# Large read buffer so the users/rooms files are pulled in with a few syscalls
+INPUT_FILE_BUFFERING = 1 << 20
+
+def load_users_csv(path="users.csv"):
+    """Parses the users csv file once into a list of dicts"""
+    with open(path, "r", encoding="utf-8", newline="", buffering=INPUT_FILE_BUFFERING) as csvfile:
+        return list(csv.DictReader(csvfile))
+
+def iter_users_csv(path="users.csv"):
+    """Yields the rows of the users csv file one at a time, closing it once they run out"""
+    with open(path, "r", encoding="utf-8", newline="", buffering=INPUT_FILE_BUFFERING) as csvfile:
+        yield from csv.DictReader(csvfile)
+
 ################################################################################
 
 
 # Preflight ####################################################################
 
+file_limit_raised = False
+
+# Each simulated user holds its own keep-alive connections, so a worker with
+# thousands of users needs far more descriptors than the usual default of 1024
+FILE_LIMIT_TARGET = 999999
+
+def raise_file_limit():
+    """Increases the open file descriptor limit, once per process
+
+    Only the soft limit is raised, as far as the hard limit allows, so this
+    works without the privileges needed to raise the hard limit
+    """
+    global file_limit_raised
+    if file_limit_raised:
+        return
+    file_limit_raised = True
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = FILE_LIMIT_TARGET if hard == resource.RLIM_INFINITY else min(hard, FILE_LIMIT_TARGET)
+    if soft == resource.RLIM_INFINITY or soft >= target:
+        return
+
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ValueError, OSError) as e:
+        logging.warning(f"Failed to increase the resource limit: {e}")
+        return
+    logging.info("Raised the open file limit from %s to %s", soft, target)
+
 @events.init.add_listener
 def on_locust_init(environment, **_kwargs):
     # Increase resource limits to prevent OS running out of descriptors
-    try:
-        resource.setrlimit(resource.RLIMIT_NOFILE, (999999, 999999))
-    except ValueError as e:
-        logging.warning(f"Failed to increase the resource limit: {e}")
+    raise_file_limit()
 
     # Register event hooks
     if isinstance(environment.runner, MasterRunner):
         print("Registered 'update_tokens' handler on master worker")
         environment.runner.register_message("update_tokens", update_tokens)
+    # Single-worker, the batches are sent to ourselves
+    elif not isinstance(environment.runner, WorkerRunner):
+        environment.runner.register_message("update_tokens", update_tokens)
 
 @events.test_stop.add_listener
 def on_test_stop(environment, **_kwargs):
-    global tokens_dict
+    global tokens_dict, token_flush_greenlet
     csv_header = ["username", "user_id", "access_token", "next_batch"]
 
+    # Send the last of the token updates before they're written out
+    if token_flush_greenlet is not None:
+        token_flush_greenlet.kill()
+        token_flush_greenlet = None
+    flush_token_updates(environment)
+
     # Write changes to tokens.csv
     with open("tokens.csv", "w", encoding="utf-8") as csvfile:
         writer = csv.DictWriter(csvfile, fieldnames=csv_header)
@@ -89,37 +148,84 @@ def on_test_stop(environment, **_kwargs):
 
 @events.test_start.add_listener
 def on_test_start(environment, **_kwargs):
-    global locust_users
+    global locust_users, token_flush_greenlet
+    if not isinstance(environment.runner, MasterRunner) and token_flush_greenlet is None:
+        token_flush_greenlet = gevent.spawn(flush_token_updates_forever, environment)
+
     if isinstance(environment.runner, MasterRunner):
         print("Loading users and sending to workers")
-        with open("users.csv", "r", encoding="utf-8") as csvfile:
-            user_reader = csv.DictReader(csvfile)
-            locust_users = [ user for user in user_reader ]
-
-            # Divide up users between all workers
-            for (client_id, index) in environment.runner.worker_indexes.items():
-                user_count = int(len(locust_users) / environment.runner.worker_index_max)
-                remainder = 0 if index != environment.runner.worker_index_max - 1 \
-                            else (len(locust_users) % environment.runner.worker_index_max)
-
-                start = index * user_count
-                end = start + user_count + remainder
-                users = locust_users[start:end]
-
-                print(f"Sending {len(users)} users to {client_id}")
-                environment.runner.send_message("load_users", users, client_id)
+        locust_users = load_users_csv()
+
+        for (client_id, users) in split_users_between_workers(environment.runner, locust_users).items():
+            print(f"Sending {len(users)} users to {client_id}")
+            send_users_to_worker(environment.runner, users, client_id)
+
+def send_users_to_worker(runner, users, client_id):
+    """Sends the worker its users a chunk at a time, see register_users_handler()
+
+    Small messages don't hold up the master's event loop the way one giant
+    message for all of a worker's users would
+    """
+    for start in range(0, max(len(users), 1), USERS_CHUNK_SIZE):
+        chunk = users[start:start + USERS_CHUNK_SIZE]
+        runner.send_message("load_users", {"users": chunk, "last": start + USERS_CHUNK_SIZE >= len(users)},
+                            client_id)
+        # Let the runner's other greenlets in between chunks
+        gevent.sleep(0)
+
+def register_users_handler(runner, handler):
+    """Registers handler for the worker's users, once all of the chunks have arrived
+
+    The handler gets a message with the complete list of users, as if they
+    had all been sent together
+    """
+    received_users = []
+
+    def receive_users_chunk(environment, msg, **kwargs):
+        received_users.extend(msg.data["users"])
+        if msg.data["last"]:
+            users = received_users.copy()
+            received_users.clear()
+            handler(environment, Message(msg.type, users, msg.node_id), **kwargs)
+
+    runner.register_message("load_users", receive_users_chunk)
+
+def split_users_between_workers(runner, users):
+    """Divides up the users between all workers, keyed by worker client_id"""
+    worker_users = {}
+    for (client_id, index) in runner.worker_indexes.items():
+        user_count = int(len(users) / runner.worker_index_max)
+        remainder = 0 if index != runner.worker_index_max - 1 \
+                    else (len(users) % runner.worker_index_max)
+
+        start = index * user_count
+        end = start + user_count + remainder
+        worker_users[client_id] = users[start:end]
+
+    return worker_users
 
 ################################################################################
 
 def update_tokens(environment, msg, **_kwargs):
-    """Updates the given user's access and sync tokens for writing to the csv file"""
+    """Updates the given users' access and sync tokens for writing to the csv file"""
     global tokens_dict
-    username = msg.data["username"]
-    user_id = msg.data["user_id"]
-    access_token = msg.data["access_token"]
-    next_batch = msg.data["next_batch"]
-
-    tokens_dict[username] = { "user_id": user_id, "access_token": access_token, "next_batch": next_batch }
+    for user_update in msg.data:
+        tokens_dict[user_update["username"]] = { "user_id": user_update["user_id"],
+                                                 "access_token": user_update["access_token"],
+                                                 "next_batch": user_update["next_batch"] }
+
+def flush_token_updates(environment):
+    """Sends all of the pending token updates in one message"""
+    if not pending_token_updates:
+        return
+    user_updates = list(pending_token_updates.values())
+    pending_token_updates.clear()
+    environment.runner.send_message("update_tokens", user_updates)
+
+def flush_token_updates_forever(environment):
+    while True:
+        gevent.sleep(TOKEN_FLUSH_INTERVAL)
+        flush_token_updates(environment)
 
 class MatrixUser(FastHttpUser):
     # Don't ever directly instantiate this class
@@ -143,7 +249,7 @@ class MatrixUser(FastHttpUser):
         self.update_tokens()
 
     def _handle_sync_response(self, response: SyncResponse) -> None:
-        self.update_tokens()
+        self.update_tokens(batched=True)
 
     def reset_client(self):
         """Resets the matrix_client state"""
@@ -154,11 +260,12 @@ class MatrixUser(FastHttpUser):
 
     def set_user(self, user_id):
         """Sets the locust username and host based on user_id"""
-        if user_id.find(":") == -1:
+        user, sep, domain = user_id.partition(":")
+        if not sep:
             self.matrix_client.user = user_id
         else:
-            self.matrix_client.user = user_id[:user_id.find(":")]
-            self.matrix_client.matrix_domain = user_id.split(":")[-1]
+            self.matrix_client.user = user
+            self.matrix_client.matrix_domain = domain
 
             protocol = self.matrix_client.locust_user.host[:self.matrix_client.locust_user.host.rfind("/") + 1]
             self.matrix_client.locust_user.host = protocol + "matrix." + self.matrix_client.matrix_domain
@@ -181,19 +288,29 @@ class MatrixUser(FastHttpUser):
             self.matrix_client.next_batch = tokens_dict[self.matrix_client.user].get("next_batch")
 
         # Handle empty strings
-        if len(self.matrix_client.user_id) < 1 or len(self.matrix_client.access_token) < 1:
+        if not (self.matrix_client.user_id and self.matrix_client.access_token):
             self.matrix_client.user_id = None
             self.matrix_client.access_token = None
             return
 
-        if len(self.matrix_client.next_batch) < 1:
+        if not self.matrix_client.next_batch:
             self.matrix_client.next_batch = None
 
-        self.matrix_client.matrix_domain = self.matrix_client.user_id.split(":")[-1]
+        # Also derives the matrix_domain from the saved user_id
+        self.matrix_client._set_identity(self.matrix_client.user_id)
 
-    def update_tokens(self) -> None:
+    def update_tokens(self, batched: bool = False) -> None:
+        """Sends the user's tokens to the master for tokens.csv
+
+        Batched updates are held back and sent together, see flush_token_updates()
+        """
         user_update_request = { "username": self.matrix_client.user,
                                 "user_id": self.matrix_client.user_id,
                                 "access_token": self.matrix_client.access_token,
                                 "next_batch": self.matrix_client.next_batch }
-        self.environment.runner.send_message("update_tokens", user_update_request)
+        if batched:
+            pending_token_updates[self.matrix_client.user] = user_update_request
+        else:
+            # Supersedes anything still pending for this user
+            pending_token_updates.pop(self.matrix_client.user, None)
+            self.environment.runner.send_message("update_tokens", [user_update_request])